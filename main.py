@@ -1,26 +1,60 @@
 import telebot
-from PIL import Image, ImageDraw, ImageChops, ImageOps
+from telebot import apihelper
+from PIL import Image, ImageDraw
 from PIL.ExifTags import TAGS, GPSTAGS
 import io
 import logging
 import os
 import requests
-from geopy.geocoders import Nominatim
-from geopy.extra.rate_limiter import RateLimiter
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from geopy.geocoders import Nominatim, Photon
+from geopy.adapters import RequestsAdapter
+from geopy.exc import GeocoderRateLimited
 import html
 import folium
-import tempfile
 from datetime import datetime
 import threading
+import multiprocessing
 import time
+import queue
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 import exifread
 import numpy as np
-from cachetools import TTLCache
-import re
+from cachetools import LRUCache, TTLCache
+import string
+import itertools
+import heapq
+import struct
+import sqlite3
+import hashlib
+import uuid
+import sys
+from collections import OrderedDict
+import json
+import ast
+from fractions import Fraction
+import base64
+import gzip
+import zipfile
 import piexif
-from hachoir.parser import createParser
+from exifread.tags.exif import EXIF_TAGS as EXIFREAD_TAGS, GPS_TAGS as EXIFREAD_GPS_TAGS, INTEROP_TAGS as EXIFREAD_INTEROP_TAGS
+from hachoir.parser import guessParser
+from hachoir.stream import InputIOStream
 from hachoir.metadata import extractMetadata
 import warnings
+import asyncio
+import functools
+import hmac
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Асинхронный режим (BOT_RUNTIME=async) требует aiohttp
+try:
+    import aiohttp
+    from telebot import asyncio_helper
+    from telebot.async_telebot import AsyncTeleBot
+except ImportError:
+    AsyncTeleBot = None
 
 # Игнорируем предупреждения hachoir
 warnings.filterwarnings("ignore", category=UserWarning)
@@ -35,22 +69,393 @@ logger = logging.getLogger(__name__)
 # Конфигурация бота
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "7858198753:AAFKpGKhF8ouWLpK6mGN7sFDYLZWm972zo4")
 bot = telebot.TeleBot(TOKEN)
-geolocator = Nominatim(user_agent="geoapiExercises")
-geocode = RateLimiter(geolocator.geocode, min_delay_seconds=1.5)
 SUPPORTED_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.heic', '.tiff', '.webp']
 MAX_FILE_SIZE = 20 * 1024 * 1024  # 20MB
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_TIMEOUT = int(os.getenv("DOWNLOAD_TIMEOUT", "60"))
+DOWNLOAD_POOL_MAXSIZE = int(os.getenv("DOWNLOAD_POOL_MAXSIZE", "8"))  # Соединений с сервером файлов Telegram
+BOT_RUNTIME = os.getenv("BOT_RUNTIME", "sync")  # sync (TeleBot, потоки) | async (AsyncTeleBot, asyncio)
+# Исходящие запросы к Telegram Bot API (лимиты Telegram: ~30 сообщений/с на бота, ~1/с в чат)
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+TELEGRAM_SENDERS = int(os.getenv("TELEGRAM_SENDERS", "4"))  # Потоков, отправляющих запросы
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "5"))  # Повторов после 429
+# Альбомы (media group): фото приходят отдельными сообщениями почти одновременно
+ALBUM_COLLECT_DELAY = float(os.getenv("ALBUM_COLLECT_DELAY", "1.0"))  # Ожидание остальных фото альбома
+ALBUM_CONCURRENCY = int(os.getenv("ALBUM_CONCURRENCY", "4"))  # Фото альбома, анализируемых одновременно
+# Получение обновлений: polling (long polling) | webhook (встроенный HTTP-сервер)
+BOT_UPDATES = os.getenv("BOT_UPDATES", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # Публичный URL для setWebhook; пустая строка - не регистрировать
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # Общий для всех процессов за балансировщиком
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_MAX_BODY = 1024 * 1024
+
+# Формат ключей метаданных: legacy (Pillow_*/ExifRead_*/Piexif_*) или merged (Exif_*)
+METADATA_KEY_MODE = os.getenv("METADATA_KEY_MODE", "legacy")
+# Сверка единого парсера со старым каскадом библиотек (для отладки)
+METADATA_COMPAT_CHECK = os.getenv("METADATA_COMPAT_CHECK", "0") == "1"
+
+# Планировщик заданий
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", "4"))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "100"))
+MAX_JOBS_PER_USER = int(os.getenv("MAX_JOBS_PER_USER", "3"))
+CPU_WORKERS = int(os.getenv("CPU_WORKERS", "0"))  # 0 - CPU-этапы выполняются в потоках воркеров
+# Постоянный кэш геокодирования (SQLite, общий для процессов на одном хосте)
+GEO_CACHE_PATH = os.getenv("GEO_CACHE_PATH", "geo_cache.sqlite3")  # Пустая строка - только кэш в памяти
+GEO_CACHE_PRECISION = int(os.getenv("GEO_CACHE_PRECISION", "8"))  # Длина geohash: 8 символов ~ 38 x 19 м
+GEO_CACHE_TTL = int(os.getenv("GEO_CACHE_TTL", str(30 * 24 * 3600)))
+GEO_CACHE_MAX_ENTRIES = int(os.getenv("GEO_CACHE_MAX_ENTRIES", "100000"))
+GEO_CACHE_EVICT_EVERY = 100  # Очистка устаревших записей раз в N записей
+# Офлайн-геокодер по локальному справочнику (GeoNames или CSV-выгрузка OSM)
+GEOCODER_MODE = os.getenv("GEOCODER_MODE", "online")  # online | offline | hybrid (офлайн + уточнение онлайн)
+GAZETTEER_PATH = os.getenv("GAZETTEER_PATH", "")
+GAZETTEER_POI_RADIUS_KM = float(os.getenv("GAZETTEER_POI_RADIUS_KM", "1.0"))
+# Общий лимит исходящих запросов к геокодерам (политика Nominatim - не больше 1 запроса в секунду)
+GEOCODER_RATE = float(os.getenv("GEOCODER_RATE", "1.0"))
+GEOCODER_BURST = int(os.getenv("GEOCODER_BURST", "1"))
+GEOCODER_WAIT_TIMEOUT = float(os.getenv("GEOCODER_WAIT_TIMEOUT", "30"))
+HYBRID_ONLINE_WAIT = float(os.getenv("HYBRID_ONLINE_WAIT", "0"))  # В hybrid без свободного токена сразу отдаем офлайн-ответ
+# Резервный Photon ограничивается отдельно: пауза Nominatim по 429 не должна его блокировать
+PHOTON_RATE = float(os.getenv("PHOTON_RATE", "1.0"))
+PHOTON_BURST = int(os.getenv("PHOTON_BURST", "1"))
+# Общий пул HTTP-соединений для геокодеров
+HTTP_POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", "10"))  # Число хостов с отдельным пулом
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "4"))  # Соединений на один хост
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "3"))
+HTTP_BACKOFF = float(os.getenv("HTTP_BACKOFF", "0.5"))
+HTTP_BACKOFF_JITTER = float(os.getenv("HTTP_BACKOFF_JITTER", "0.3"))
+# Карта в отчете
+MAP_RENDERER = os.getenv("MAP_RENDERER", "leaflet")  # leaflet (встроенный шаблон) | folium
+MAP_ZOOM = 15
+MAP_CACHE_PRECISION = int(os.getenv("MAP_CACHE_PRECISION", "5"))
+MAP_CACHE_SIZE = int(os.getenv("MAP_CACHE_SIZE", "500"))
+# Упаковка результатов: separate (ELA фото + HTML) | media_group (одной медиагруппой документов)
+# | inline (ELA в отчете как WebP data URI) | gzip (inline + .html.gz) | zip (отчет и ELA в одном архиве)
+REPORT_PACKAGING_MODES = ("separate", "media_group", "inline", "gzip", "zip")
+REPORT_PACKAGING = os.getenv("REPORT_PACKAGING", "separate")
+REPORT_EMBED_ELA = REPORT_PACKAGING in ("inline", "gzip")
+REPORT_WEBP_QUALITY = int(os.getenv("REPORT_WEBP_QUALITY", "80"))
+REPORT_GZIP_LEVEL = int(os.getenv("REPORT_GZIP_LEVEL", "9"))
+# Хранилище заданий (по одному на загрузку)
+SESSION_MEMORY_BUDGET = int(os.getenv("SESSION_MEMORY_BUDGET_MB", "256")) * 1024 * 1024
+SESSION_TTL = int(os.getenv("SESSION_TTL", "3600"))  # Время жизни завершенных сессий
+SESSION_SPILL_DIR = os.getenv("SESSION_SPILL_DIR", "")  # Пустая строка - без выгрузки на диск
+SESSION_SPILL_THRESHOLD = int(os.getenv("SESSION_SPILL_THRESHOLD_KB", "256")) * 1024
+# Кэш результатов анализа по хэшу содержимого
+RESULT_CACHE_MEMORY = int(os.getenv("RESULT_CACHE_MEMORY_MB", "64")) * 1024 * 1024
+RESULT_CACHE_PATH = os.getenv("RESULT_CACHE_PATH", "")  # SQLite; пустая строка - только кэш в памяти
+RESULT_CACHE_DISK = int(os.getenv("RESULT_CACHE_DISK_MB", "1024")) * 1024 * 1024
+RESULT_CACHE_EVICT_EVERY = 50
+RESULT_CACHE_VERSION = 2  # Записи другой версии формата игнорируются
+FILE_INDEX_SIZE = int(os.getenv("FILE_INDEX_SIZE", "100000"))
+# Поиск почти-дубликатов (перекодированные и уменьшенные копии)
+PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", "4"))  # Максимум различающихся бит из 64
+PHASH_INDEX_SIZE = int(os.getenv("PHASH_INDEX_SIZE", "5000"))  # Учитывается в SESSION_MEMORY_BUDGET
+STATUS_EDIT_INTERVAL = float(os.getenv("STATUS_EDIT_INTERVAL", "1.0"))  # Не чаще одной правки статуса в секунду
 
 # Глобальные переменные
-user_data = {}
-geo_cache = TTLCache(maxsize=1000, ttl=3600)  # Кэш на 1 час
+geo_cache = TTLCache(maxsize=1000, ttl=3600)  # Кэш на 1 час (первый уровень перед SQLite)
+geo_db_local = threading.local()
+geo_db_writes = 0
+map_cache = LRUCache(maxsize=MAP_CACHE_SIZE)  # (рендерер, широта, долгота, zoom) -> HTML карты
+gazetteer = None
+gazetteer_lock = threading.Lock()
 cache_lock = threading.Lock()
+job_queue = queue.Queue(maxsize=JOB_QUEUE_SIZE)
+user_jobs = {}  # user_id -> число заданий в очереди и в работе
+busy_workers = 0
+jobs_lock = threading.Lock()
+workers = []
+cpu_pool = None
+album_buffers = {}  # (chat_id, media_group_id) -> собираемый альбом
+album_lock = threading.Lock()
+album_pool = ThreadPoolExecutor(max_workers=ALBUM_CONCURRENCY, thread_name_prefix="album-item")
+update_queue = queue.Queue(maxsize=WEBHOOK_QUEUE_SIZE)  # Тела обновлений, принятых вебхуком
+stage_pool = ThreadPoolExecutor(max_workers=WORKER_COUNT * 2, thread_name_prefix="image-stage")
+
+# Хранилище сессий пользователей с бюджетом памяти
+class SpilledBlob:
+    """Ссылка на крупный бинарный объект, выгруженный на диск"""
+    __slots__ = ('path', 'size')
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def delete(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+class Job:
+    """Состояние одной загрузки: свое статусное сообщение, тайминги и результаты"""
+    __slots__ = (
+        'id', 'user_id', 'chat_id', 'message', 'image_bytes', 'file_id', 'file_unique_id',
+        'digest', 'album', 'status', 'result', 'active', 'created', 'started', 'finished', 'lock'
+    )
+
+    def __init__(self, message, image_bytes=None, file_id=None, file_unique_id=None, digest=None, album=None):
+        self.id = uuid.uuid4().hex
+        self.user_id = message.from_user.id
+        self.chat_id = message.chat.id
+        self.message = message
+        self.image_bytes = image_bytes
+        self.file_id = file_id
+        self.file_unique_id = file_unique_id
+        self.digest = digest
+        self.album = album  # Элементы альбома (media group) или None
+        self.status = None  # StatusMessage после create_status_message
+        self.result = None
+        self.active = True
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.lock = threading.Lock()  # Защищает статус задания от гонок между потоками
+
+class StatusMessage:
+    """Статусное сообщение задания: состояние этапов и отложенная отправка правок"""
+    __slots__ = ('message_id', 'steps', 'finished', 'queued_text', 'last_edited_text', 'last_update', 'flush_timer')
+
+    def __init__(self):
+        self.message_id = None
+        self.steps = {}  # этап -> (статус, пояснение); отсутствующие этапы еще не начаты
+        self.finished = False
+        self.queued_text = None  # Последний текст, поставленный в очередь на отправку
+        self.last_edited_text = None  # Последний текст, который Telegram подтвердил
+        self.last_update = time.time()
+        self.flush_timer = None
+
+class JobStore:
+    """Задания с LRU/TTL-вытеснением завершенных и выгрузкой крупных объектов на диск"""
+
+    def __init__(self, budget, ttl, spill_dir="", spill_threshold=0):
+        self.budget = budget
+        self.ttl = ttl
+        self.spill_dir = spill_dir
+        self.spill_threshold = spill_threshold
+        self.jobs = OrderedDict()  # id задания -> Job (от давних к недавним)
+        self.sizes = {}
+        self.updated = {}
+        self.memory_bytes = 0
+        self.evictions = 0
+        self.shared = []  # Кэши с общим бюджетом памяти: memory_bytes и shrink(байты)
+        self.lock = threading.RLock()
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def __contains__(self, job_id):
+        with self.lock:
+            return job_id in self.jobs
+
+    def __getitem__(self, job_id):
+        with self.lock:
+            self.jobs.move_to_end(job_id)
+            return self.jobs[job_id]
+
+    def share_budget(self, cache):
+        """Учитывает память кэша в общем бюджете; при нехватке он сжимается после заданий"""
+        with self.lock:
+            self.shared.append(cache)
+
+    def used_bytes(self):
+        with self.lock:
+            return self.memory_bytes + sum(cache.memory_bytes for cache in self.shared)
+
+    def add(self, job):
+        with self.lock:
+            self.jobs[job.id] = job
+            self._account(job.id)
+            self.evict()
+
+    def pop(self, job_id):
+        """Удаляет задание вместе с выгруженными на диск объектами"""
+        with self.lock:
+            job = self.jobs.pop(job_id, None)
+            if job is None:
+                return None
+            self.memory_bytes -= self.sizes.pop(job_id, 0)
+            self.updated.pop(job_id, None)
+            for blob in self._blobs(job):
+                blob.delete()
+            return job
+
+    def update(self, job_id, fields):
+        """Обновляет поля задания; крупные бинарные объекты выгружаются на диск"""
+        with self.lock:
+            job = self.jobs[job_id]
+            for key, value in fields.items():
+                setattr(job, key, self._spill(value))
+            self.jobs.move_to_end(job_id)
+            self._account(job_id)
+            self.evict()
+
+    def finish(self, job_id):
+        """Отмечает задание завершенным и сразу освобождает исходное изображение"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return
+            job.image_bytes = None
+            job.active = False
+            job.finished = time.time()
+            self._account(job_id)
+            self.evict()
+
+    def evict(self):
+        """Вытесняет завершенные задания: сначала просроченные, затем самые давние сверх бюджета"""
+        with self.lock:
+            now = time.time()
+            finished = [job_id for job_id, job in self.jobs.items() if not job.active]
+            for job_id in finished:
+                if now - self.updated[job_id] > self.ttl:
+                    self.pop(job_id)
+                    self.evictions += 1
+            for job_id in finished:
+                if self.used_bytes() <= self.budget:
+                    break
+                if job_id in self.jobs:
+                    self.pop(job_id)
+                    self.evictions += 1
+            for cache in self.shared:
+                excess = self.used_bytes() - self.budget
+                if excess <= 0:
+                    break
+                cache.shrink(excess)
+            if self.used_bytes() > self.budget:
+                logger.warning(f"Job store over budget with active jobs only: {self.stats()}")
+
+    def stats(self):
+        """Текущая заполненность хранилища"""
+        with self.lock:
+            spilled = sum(blob.size for job in self.jobs.values() for blob in self._blobs(job))
+            return {
+                'jobs': len(self.jobs),
+                'active': sum(1 for job in self.jobs.values() if job.active),
+                'memory_mb': round(self.memory_bytes / 1024 / 1024, 2),
+                'shared_mb': round(sum(cache.memory_bytes for cache in self.shared) / 1024 / 1024, 2),
+                'budget_mb': round(self.budget / 1024 / 1024, 2),
+                'spilled_mb': round(spilled / 1024 / 1024, 2),
+                'evictions': self.evictions
+            }
+
+    def _account(self, job_id):
+        size = estimate_size(self.jobs[job_id])
+        self.memory_bytes += size - self.sizes.get(job_id, 0)
+        self.sizes[job_id] = size
+        self.updated[job_id] = time.time()
+
+    def _spill(self, value):
+        if not self.spill_dir:
+            return value
+        if isinstance(value, dict):
+            # Копия: исходный словарь может использоваться вызывающим кодом
+            return {key: self._spill(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self._spill(item) for item in value]
+        if isinstance(value, bytes) and len(value) >= self.spill_threshold:
+            path = os.path.join(self.spill_dir, uuid.uuid4().hex)
+            with open(path, 'wb') as f:
+                f.write(value)
+            return SpilledBlob(path, len(value))
+        return value
+
+    def _blobs(self, job):
+        pending = [getattr(job, name) for name in Job.__slots__]
+        while pending:
+            value = pending.pop()
+            if isinstance(value, SpilledBlob):
+                yield value
+            elif isinstance(value, dict):
+                pending.extend(value.values())
+            elif isinstance(value, (list, tuple)):
+                pending.extend(value)
+
+def estimate_size(value):
+    """Приблизительный размер данных задания в байтах (крупные объекты учитываются точно)"""
+    if isinstance(value, (Job, StatusMessage)):
+        return sys.getsizeof(value) + sum(estimate_size(getattr(value, name)) for name in value.__slots__)
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_size(k) + estimate_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(estimate_size(item) for item in value)
+    if isinstance(value, str):
+        return sys.getsizeof(value)
+    return 64  # Сообщения Telegram, числа и прочие мелкие объекты
+
+job_store = JobStore(SESSION_MEMORY_BUDGET, SESSION_TTL, SESSION_SPILL_DIR, SESSION_SPILL_THRESHOLD)
+result_cache = LRUCache(maxsize=RESULT_CACHE_MEMORY, getsizeof=estimate_size)  # хэш файла -> результат анализа
+result_db_local = threading.local()
+result_db_writes = 0
+file_index = LRUCache(maxsize=FILE_INDEX_SIZE)  # file_unique_id Telegram -> хэш содержимого
+
+# Пулы HTTP-соединений (keep-alive): геокодеры и скачивание файлов Telegram
+def create_http_retry():
+    """Повторы с экспоненциальной задержкой и джиттером"""
+    retry_options = dict(
+        total=HTTP_RETRIES,
+        backoff_factor=HTTP_BACKOFF,
+        status_forcelist=(500, 502, 503, 504),  # 429 обрабатывает лимитер геокодеров
+        allowed_methods=frozenset(["GET"]),
+        raise_on_status=False
+    )
+    try:
+        retry = Retry(backoff_jitter=HTTP_BACKOFF_JITTER, **retry_options)
+    except TypeError:
+        # urllib3 < 2.0 не поддерживает джиттер
+        retry = Retry(**retry_options)
+    return retry
+
+def create_download_session():
+    """Отдельный пул для скачивания файлов Telegram: не конкурирует с геокодерами"""
+    # Повторяем только установку соединения: оборванный поток файла повторять бессмысленно.
+    # Без pool_block: лишние соединения открываются сверх пула, а не ждут очереди
+    http_adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=DOWNLOAD_POOL_MAXSIZE,
+        max_retries=Retry(total=HTTP_RETRIES, connect=HTTP_RETRIES, read=0, status=0, backoff_factor=HTTP_BACKOFF)
+    )
+    session = requests.Session()
+    session.mount("https://", http_adapter)
+    session.mount("http://", http_adapter)
+    return session
+
+# Адаптер geopy сам настраивает ssl_context и прокси; передаем ему только параметры пула.
+# pool_block ограничивает число одновременных соединений с одним хостом
+geocoder_adapter = functools.partial(
+    RequestsAdapter,
+    pool_connections=HTTP_POOL_CONNECTIONS,
+    pool_maxsize=HTTP_POOL_MAXSIZE,
+    max_retries=create_http_retry(),
+    pool_block=True
+)
+download_session = create_download_session()
+geolocator = Nominatim(user_agent="geoapiExercises", adapter_factory=geocoder_adapter)
+backup_geolocator = Photon(user_agent="geo_backup", adapter_factory=geocoder_adapter)
 
 # Функции для конвертации координат и геолокации
+def rational_to_float(value):
+    """Конвертирует EXIF-дробь (числитель, знаменатель) в число"""
+    numerator, denominator = value
+    return numerator / denominator if denominator else 0.0
+
 def convert_to_degrees(value):
     """Конвертирует координаты в градусы"""
     try:
         if isinstance(value, tuple) and len(value) == 3:
-            d, m, s = value
+            d, m, s = (rational_to_float(v) if isinstance(v, tuple) else v for v in value)
             return d + (m / 60.0) + (s / 3600.0)
         elif isinstance(value, exifread.classes.IfdTag):
             d = value.values[0].decimal()
@@ -63,197 +468,992 @@ def convert_to_degrees(value):
         logger.error(f"Coordinate conversion error: {e}")
         return None
 
-def get_location_info(lat, lon):
-    """Получает информацию о местоположении"""
-    cache_key = f"{lat:.6f},{lon:.6f}"
+def landmark_from_address(address):
+    """Выбирает достопримечательность из адресных деталей Nominatim"""
+    landmark = address.get('tourism') or address.get('historic') or address.get('amenity')
+    return landmark if landmark else address.get('road', '') + ', ' + address.get('city', address.get('town', ''))
+
+def landmark_from_photon(properties):
+    """Выбирает достопримечательность из ответа Photon"""
+    if properties.get('osm_key') in ('tourism', 'historic', 'amenity') and properties.get('name'):
+        return properties['name']
+    return properties.get('street', '') + ', ' + properties.get('city', '')
+
+# Постоянный кэш геокодирования
+GEOHASH_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+def geohash_encode(lat, lon, precision=GEO_CACHE_PRECISION):
+    """Кодирует координаты в geohash заданной длины (ячейка сетки)"""
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars = []
+    bits, bit_count, even = 0, 0, True
+    while len(chars) < precision:
+        value_range, value = (lon_range, lon) if even else (lat_range, lat)
+        middle = (value_range[0] + value_range[1]) / 2
+        if value >= middle:
+            bits = (bits << 1) | 1
+            value_range[0] = middle
+        else:
+            bits <<= 1
+            value_range[1] = middle
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(GEOHASH_BASE32[bits])
+            bits, bit_count = 0, 0
+    return "".join(chars)
+
+def get_geo_db():
+    """Возвращает соединение с SQLite-кэшем для текущего потока"""
+    if not GEO_CACHE_PATH:
+        return None
+    conn = getattr(geo_db_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(GEO_CACHE_PATH, timeout=5, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS geo_cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS geo_cache_accessed ON geo_cache (accessed)")
+        geo_db_local.conn = conn
+    return conn
+
+def geo_cache_get(key):
+    """Ищет результат геокодирования в памяти, затем в SQLite"""
+    with cache_lock:
+        if key in geo_cache:
+            return geo_cache[key]
     
+    try:
+        conn = get_geo_db()
+        if conn is None:
+            return None
+        now = time.time()
+        row = conn.execute(
+            "SELECT value FROM geo_cache WHERE key = ? AND created >= ?", (key, now - GEO_CACHE_TTL)
+        ).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE geo_cache SET accessed = ? WHERE key = ?", (now, key))
+        result = json.loads(row[0])
+        with cache_lock:
+            geo_cache[key] = result
+        return result
+    except Exception as e:
+        logger.error(f"Geo cache read error: {e}")
+        return None
+
+def geo_cache_put(key, result):
+    """Сохраняет результат геокодирования в памяти и в SQLite"""
+    global geo_db_writes
     with cache_lock:
-        if cache_key in geo_cache:
-            return geo_cache[cache_key]
+        geo_cache[key] = result
+        geo_db_writes += 1
+        evict = geo_db_writes % GEO_CACHE_EVICT_EVERY == 0
+    
+    try:
+        conn = get_geo_db()
+        if conn is None:
+            return
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO geo_cache (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(result, ensure_ascii=False), now, now)
+        )
+        if evict:
+            evict_geo_cache(conn)
+    except Exception as e:
+        logger.error(f"Geo cache write error: {e}")
+
+def evict_geo_cache(conn):
+    """Удаляет устаревшие записи (TTL) и самые давно использованные сверх лимита (LRU)"""
+    conn.execute("DELETE FROM geo_cache WHERE created < ?", (time.time() - GEO_CACHE_TTL,))
+    conn.execute(
+        "DELETE FROM geo_cache WHERE key IN ("
+        "SELECT key FROM geo_cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+        (GEO_CACHE_MAX_ENTRIES,)
+    )
+
+# Ограничение частоты и объединение одинаковых запросов к геокодерам
+class TokenBucket:
+    """Потокобезопасный token bucket с поддержкой паузы после 429"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self, timeout=None):
+        """Ждет свободный токен; возвращает False, если не дождался за timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def try_acquire(self):
+        """Берет токен без ожидания; возвращает 0 или время до появления токена"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if now >= self.paused_until and self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return max(self.paused_until - now, (1 - self.tokens) / self.rate)
+
+    def refund(self):
+        """Возвращает токен, взятый для запроса, который не был отправлен"""
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + 1)
+
+    def pause(self, seconds):
+        """Приостанавливает выдачу токенов (например, по Retry-After)"""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0.0
+
+geocoder_limiter = TokenBucket(GEOCODER_RATE, GEOCODER_BURST)
+photon_limiter = TokenBucket(PHOTON_RATE, PHOTON_BURST)
+geocoding_inflight = {}  # cache_key -> Future выполняющегося запроса
+inflight_lock = threading.Lock()
+
+def call_geocoder(limiter, wait_timeout, func, *args, **kwargs):
+    """Выполняет исходящий запрос к геокодеру через лимитер этого провайдера (ждет токен не дольше wait_timeout)"""
+    if not limiter.acquire(timeout=wait_timeout):
+        raise TimeoutError("Geocoder rate limit wait timeout")
+    try:
+        return func(*args, **kwargs)
+    except GeocoderRateLimited as e:
+        # Приостанавливается только провайдер, ответивший 429
+        limiter.pause(e.retry_after or 60)
+        raise
+
+def single_flight(key, func, *args):
+    """Объединяет одновременные одинаковые запросы: выполняется только первый"""
+    with inflight_lock:
+        future = geocoding_inflight.get(key)
+        leader = future is None
+        if leader:
+            future = Future()
+            geocoding_inflight[key] = future
+    
+    if not leader:
+        return future.result()
+    
+    try:
+        result = func(*args)
+        future.set_result(result)
+        return result
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with inflight_lock:
+            geocoding_inflight.pop(key, None)
+
+def reverse_geocode(lat, lon, wait_timeout=None):
+    """Один запрос обратного геокодирования (zoom 18) для адреса и достопримечательности"""
+    if wait_timeout is None:
+        wait_timeout = GEOCODER_WAIT_TIMEOUT
+    cache_key = geohash_encode(lat, lon)
+    cached = geo_cache_get(cache_key)
+    if cached:
+        return cached
     
+    return single_flight(cache_key, fetch_reverse_geocode, lat, lon, cache_key, wait_timeout)
+
+def fetch_reverse_geocode(lat, lon, cache_key, wait_timeout):
+    """Запрашивает Nominatim (с резервным Photon) и сохраняет результат в кэш"""
     try:
-        location = geolocator.reverse(f"{lat}, {lon}", language='ru', timeout=15)
+        location = call_geocoder(geocoder_limiter, wait_timeout, geolocator.reverse, f"{lat}, {lon}", language='ru', zoom=18, addressdetails=True, timeout=15)
         if location:
+            address = location.raw.get('address')
             result = {
                 'address': location.address,
-                'details': location.raw.get('display_name', '')
+                'details': location.raw.get('display_name', ''),
+                'landmark': landmark_from_address(address) if address else None
             }
-            with cache_lock:
-                geo_cache[cache_key] = result
+            geo_cache_put(cache_key, result)
             return result
     except Exception as e:
         logger.error(f"Geocoding error: {e}")
         try:
             # Попробуем резервный геокодер
-            from geopy.geocoders import Photon
-            backup_geolocator = Photon(user_agent="geo_backup")
-            location = backup_geolocator.reverse(f"{lat}, {lon}", language='ru', timeout=10)
+            location = call_geocoder(photon_limiter, wait_timeout, backup_geolocator.reverse, f"{lat}, {lon}", language='ru', timeout=10)
             if location:
                 result = {
                     'address': location.address,
-                    'details': location.raw.get('display_name', '')
+                    'details': location.raw.get('display_name', ''),
+                    'landmark': landmark_from_photon(location.raw.get('properties', {}))
                 }
-                with cache_lock:
-                    geo_cache[cache_key] = result
+                geo_cache_put(cache_key, result)
                 return result
         except Exception as backup_e:
             logger.error(f"Backup geocoding error: {backup_e}")
     
-    return {'address': "Местоположение не определено", 'details': ""}
+    return None
 
-def get_landmark(lat, lon):
-    """Находит ближайшую достопримечательность"""
-    cache_key = f"landmark_{lat:.6f},{lon:.6f}"
+# Офлайн-геокодер
+EARTH_RADIUS_KM = 6371.0
+GEONAMES_POI_CLASSES = ('S', 'L')  # Здания, объекты, парки и заповедники
+
+class GazetteerIndex:
+    """KD-дерево по точкам справочника (единичные векторы на сфере)"""
+    LEAF_SIZE = 16
+
+    def __init__(self, lats, lons, names, countries):
+        lat_rad = np.radians(np.asarray(lats, dtype=np.float64))
+        lon_rad = np.radians(np.asarray(lons, dtype=np.float64))
+        points = np.column_stack((
+            np.cos(lat_rad) * np.cos(lon_rad),
+            np.cos(lat_rad) * np.sin(lon_rad),
+            np.sin(lat_rad)
+        ))
+        order = np.arange(len(points))
+        # Узлы: (начало, конец, ось, значение разделения, левый, правый); у листа ось = -1
+        self.nodes = []
+        if len(points):
+            self._build(points, order, 0, len(points))
+        self.points = points[order]
+        self.names = [names[i] for i in order]
+        self.countries = [countries[i] for i in order]
+
+    def __len__(self):
+        return len(self.names)
+
+    def _build(self, points, order, start, end):
+        node_id = len(self.nodes)
+        self.nodes.append(None)
+        if end - start <= self.LEAF_SIZE:
+            self.nodes[node_id] = (start, end, -1, 0.0, -1, -1)
+            return node_id
+        
+        segment = points[order[start:end]]
+        axis = int(np.argmax(segment.max(axis=0) - segment.min(axis=0)))
+        mid = (end - start) // 2
+        partition = np.argpartition(segment[:, axis], mid)
+        order[start:end] = order[start:end][partition]
+        split = points[order[start + mid], axis]
+        
+        left = self._build(points, order, start, start + mid)
+        right = self._build(points, order, start + mid, end)
+        self.nodes[node_id] = (start, end, axis, split, left, right)
+        return node_id
+
+    def nearest(self, lat, lon):
+        """Возвращает (индекс, расстояние в км) ближайшей точки"""
+        if not self.nodes:
+            return None, None
+        lat_rad, lon_rad = np.radians(lat), np.radians(lon)
+        target = np.array((
+            np.cos(lat_rad) * np.cos(lon_rad),
+            np.cos(lat_rad) * np.sin(lon_rad),
+            np.sin(lat_rad)
+        ))
+        
+        best_index, best_dist = -1, np.inf
+        stack = [(0, 0.0)]
+        while stack:
+            node_id, bound = stack.pop()
+            if bound >= best_dist:
+                continue
+            start, end, axis, split, left, right = self.nodes[node_id]
+            if axis == -1:
+                dists = ((self.points[start:end] - target) ** 2).sum(axis=1)
+                i = int(np.argmin(dists))
+                if dists[i] < best_dist:
+                    best_index, best_dist = start + i, float(dists[i])
+                continue
+            diff = target[axis] - split
+            near, far = (left, right) if diff < 0 else (right, left)
+            stack.append((far, diff * diff))
+            stack.append((near, bound))
+        
+        # Хорда между единичными векторами -> расстояние по дуге
+        chord = np.sqrt(best_dist)
+        return best_index, float(2 * np.arcsin(min(chord / 2, 1.0)) * EARTH_RADIUS_KM)
+
+def load_gazetteer(path):
+    """Загружает справочник: TSV GeoNames или CSV с колонками name,lat,lon,kind[,country]"""
+    settlements = ([], [], [], [])
+    pois = ([], [], [], [])
     
-    with cache_lock:
-        if cache_key in geo_cache:
-            return geo_cache[cache_key]
+    with open(path, 'r', encoding='utf-8') as f:
+        first_line = f.readline()
+        if first_line.startswith('name,'):
+            # CSV-выгрузка OSM: kind = place для населенных пунктов, иначе POI
+            import csv
+            for row in csv.DictReader(f, fieldnames=first_line.strip().split(',')):
+                target = settlements if row.get('kind') == 'place' else pois
+                append_gazetteer_row(target, row['lat'], row['lon'], row['name'], row.get('country', ''))
+        else:
+            # GeoNames: geonameid, name, asciiname, alternatenames, latitude, longitude, feature class, ..., country code
+            f.seek(0)
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) < 9:
+                    continue
+                if fields[6] == 'P':
+                    target = settlements
+                elif fields[6] in GEONAMES_POI_CLASSES:
+                    target = pois
+                else:
+                    continue
+                append_gazetteer_row(target, fields[4], fields[5], fields[1], fields[8])
     
+    result = {
+        'settlements': GazetteerIndex(*settlements),
+        'pois': GazetteerIndex(*pois)
+    }
+    logger.info(f"Gazetteer loaded: {len(result['settlements'])} settlements, {len(result['pois'])} POI")
+    return result
+
+def append_gazetteer_row(target, lat, lon, name, country):
+    """Добавляет точку справочника, пропуская некорректные строки"""
     try:
-        url = f"https://nominatim.openstreetmap.org/reverse?format=json&lat={lat}&lon={lon}&zoom=18&addressdetails=1"
-        response = requests.get(url, timeout=15)
-        response.raise_for_status()
-        data = response.json()
-        
-        if 'address' in data:
-            address = data['address']
-            landmark = address.get('tourism') or address.get('historic') or address.get('amenity')
-            result = landmark if landmark else address.get('road', '') + ', ' + address.get('city', address.get('town', ''))
-            
-            with cache_lock:
-                geo_cache[cache_key] = result
-            return result
-    except Exception as e:
-        logger.error(f"Landmark search error: {e}")
+        lat, lon = float(lat), float(lon)
+    except (TypeError, ValueError):
+        return
+    target[0].append(lat)
+    target[1].append(lon)
+    target[2].append(name)
+    target[3].append(country)
+
+def get_gazetteer():
+    """Лениво загружает справочник из GAZETTEER_PATH"""
+    global gazetteer
+    if gazetteer is None and GAZETTEER_PATH:
+        with gazetteer_lock:
+            if gazetteer is None:
+                try:
+                    gazetteer = load_gazetteer(GAZETTEER_PATH)
+                except Exception as e:
+                    logger.error(f"Gazetteer loading error: {e}")
+                    gazetteer = {}
+    return gazetteer or None
+
+def offline_reverse_geocode(lat, lon):
+    """Ищет ближайший населенный пункт и POI по локальному справочнику"""
+    index = get_gazetteer()
+    if not index:
+        return None
+    
+    settlement, distance = index['settlements'].nearest(lat, lon)
+    if settlement is None:
+        return None
+    
+    settlements = index['settlements']
+    place = settlements.names[settlement]
+    country = settlements.countries[settlement]
+    address = f"{place}, {country}" if country else place
     
+    landmark = None
+    poi, poi_distance = index['pois'].nearest(lat, lon)
+    if poi is not None and poi_distance <= GAZETTEER_POI_RADIUS_KM:
+        landmark = index['pois'].names[poi]
+    
+    return {
+        'address': address,
+        'details': f"{place} (~{distance:.1f} км)",
+        'landmark': landmark or f"{place} (~{distance:.1f} км)"
+    }
+
+def locate(lat, lon):
+    """Определяет местоположение согласно GEOCODER_MODE"""
+    if GEOCODER_MODE == "online":
+        return reverse_geocode(lat, lon)
+    
+    local = offline_reverse_geocode(lat, lon)
+    if GEOCODER_MODE == "offline":
+        return local
+    # hybrid: офлайн-ответ уточняется онлайн-геокодером, только если у того есть свободный токен
+    return reverse_geocode(lat, lon, wait_timeout=HYBRID_ONLINE_WAIT) or local
+
+def get_location_info(lat, lon):
+    """Получает информацию о местоположении"""
+    result = locate(lat, lon)
+    if result:
+        return {'address': result['address'], 'details': result['details']}
+    return {'address': "Местоположение не определено", 'details': ""}
+
+def get_landmark(lat, lon):
+    """Находит ближайшую достопримечательность"""
+    result = locate(lat, lon)
+    if result and result['landmark']:
+        return result['landmark']
     return "Достопримечательность не найдена"
 
-# Функции для работы со статусными сообщениями
-def update_status_message(user_id, new_status):
-    """Обновляет статусное сообщение"""
-    try:
-        if user_id not in user_data or 'status_message' not in user_data[user_id]:
-            return
+# Шлюз исходящих запросов к Telegram
+class OutboundRequest:
+    """Запрос к Bot API в очереди шлюза"""
+    __slots__ = ('method', 'call', 'chat_id', 'priority', 'future', 'merge_key', 'attempts', 'cancelled')
 
-        msg_data = user_data[user_id]['status_message']
-        
-        # Проверяем, изменился ли текст
-        if msg_data.get('last_edited_text') == new_status:
-            return
+    def __init__(self, method, args, kwargs, chat_id, priority):
+        self.method = method
+        self.call = (args, kwargs)  # Заменяется целиком при слиянии правок
+        self.chat_id = chat_id
+        self.priority = priority
+        self.future = Future()
+        self.merge_key = None
+        self.attempts = 0
+        self.cancelled = False
+
+class TelegramGateway:
+    """Единая очередь исходящих запросов: лимиты по чатам и на бота, повторы по retry_after, приоритеты"""
+    PRIORITY_RESULT = 0  # Итоговые сообщения, отчеты, ответы пользователю
+    PRIORITY_STATUS = 1  # Промежуточные правки и удаление статусных сообщений
+    STATUS_METHODS = frozenset(('edit_message_text', 'delete_message'))
+    METHODS = frozenset((
+        'send_message', 'reply_to', 'send_photo', 'send_document', 'send_media_group',
+        'edit_message_text', 'delete_message'
+    ))
+
+    def __init__(self, senders, global_rate, chat_rate, chat_burst, max_retries):
+        self.senders = senders
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = LRUCache(maxsize=10000)  # chat_id -> TokenBucket
+        self.max_retries = max_retries
+        self.ready = []  # куча (приоритет, номер, запрос)
+        self.delayed = []  # куча (не раньше, номер, запрос) - ждут токен или retry_after
+        self.pending_edits = {}  # (chat_id, message_id) -> еще не отправленная правка
+        self.sending_edits = set()  # Сообщения, правка которых отправляется прямо сейчас
+        self.blocked_edits = {}  # Правки, ждущие завершения предыдущей правки того же сообщения
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.threads = []
+
+    def __getattr__(self, method):
+        """Блокирующий вызов метода бота через очередь: telegram.send_message(...)"""
+        if method not in self.METHODS:
+            raise AttributeError(f"{type(self).__name__} does not proxy {method!r}")
+        def call(*args, **kwargs):
+            return self.submit(method, *args, **kwargs).result()
+        return call
+
+    def submit(self, method, *args, **kwargs):
+        """Ставит запрос в очередь; возвращает Future с ответом Bot API"""
+        if method not in self.METHODS:
+            raise AttributeError(f"{type(self).__name__} does not proxy {method!r}")
+        chat_id = self._chat_of(args, kwargs)
+        priority = self.PRIORITY_STATUS if method in self.STATUS_METHODS else self.PRIORITY_RESULT
+        with self.condition:
+            self._start()
+            if method == 'edit_message_text':
+                key = (chat_id, kwargs.get('message_id'))
+                queued = self.pending_edits.get(key)
+                if queued:
+                    # Более новая правка того же сообщения заменяет еще не отправленную
+                    queued.call = (args, kwargs)
+                    return queued.future
             
-        msg_data['status'] = new_status
+            request = OutboundRequest(method, args, kwargs, chat_id, priority)
+            if method == 'edit_message_text':
+                request.merge_key = key
+                self.pending_edits[key] = request
+            elif method == 'delete_message':
+                # Правки удаляемого сообщения отправлять уже незачем
+                message_id = args[1] if len(args) > 1 else kwargs.get('message_id')
+                stale = self.pending_edits.pop((chat_id, message_id), None)
+                if stale:
+                    stale.cancelled = True
+            heapq.heappush(self.ready, (priority, next(self.counter), request))
+            self.condition.notify()
+        return request.future
+
+    def _start(self):
+        if self.threads:
+            return
+        for i in range(self.senders):
+            thread = threading.Thread(target=self._run, name=f"telegram-sender-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _run(self):
+        while True:
+            request = self._next()
+            if request.cancelled:
+                request.future.set_result(None)
+                continue
+            if self._wait_for_previous_edit(request):
+                continue
+            wait = self._acquire(request.chat_id)
+            if wait:
+                self._schedule(request, wait)
+                continue
+            self._send(request)
+
+    def _next(self):
+        """Следующий запрос: сначала наступившие отложенные, затем по приоритету"""
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                while self.delayed and self.delayed[0][0] <= now:
+                    request = heapq.heappop(self.delayed)[2]
+                    heapq.heappush(self.ready, (request.priority, next(self.counter), request))
+                if self.ready:
+                    return heapq.heappop(self.ready)[2]
+                self.condition.wait(self.delayed[0][0] - now if self.delayed else None)
+
+    def _wait_for_previous_edit(self, request):
+        """Правки одного сообщения уходят по очереди: иначе старый текст может прийти после нового"""
+        with self.condition:
+            if request.merge_key is None or request.merge_key not in self.sending_edits:
+                return False
+            # Остается в pending_edits: более новые правки продолжают сливаться в нее
+            self.blocked_edits[request.merge_key] = request
+            return True
+
+    def _edit_done(self, request):
+        with self.condition:
+            self.sending_edits.discard(request.merge_key)
+            blocked = self.blocked_edits.pop(request.merge_key, None)
+            if blocked:
+                heapq.heappush(self.ready, (blocked.priority, next(self.counter), blocked))
+                self.condition.notify()
+
+    def _acquire(self, chat_id):
+        """Токен чата и общий токен бота; возвращает 0 или время ожидания"""
+        bucket = self._chat_bucket(chat_id)
+        wait = bucket.try_acquire() if bucket else 0.0
+        if wait:
+            return wait
+        wait = self.global_bucket.try_acquire()
+        if wait and bucket:
+            bucket.refund()
+        return wait
+
+    def _chat_bucket(self, chat_id):
+        if chat_id is None:
+            return None
+        with self.condition:
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            return bucket
+
+    def _schedule(self, request, delay):
+        with self.condition:
+            if request.cancelled:
+                request.future.set_result(None)
+                return
+            if request.merge_key:
+                queued = self.pending_edits.get(request.merge_key)
+                if queued is not None and queued is not request:
+                    # Пока запрос ждал, пришла более новая правка
+                    request.future.set_result(None)
+                    return
+                self.pending_edits[request.merge_key] = request
+            heapq.heappush(self.delayed, (time.monotonic() + delay, next(self.counter), request))
+            self.condition.notify()
+
+    def _send(self, request):
+        with self.condition:
+            if request.merge_key:
+                if self.pending_edits.get(request.merge_key) is request:
+                    del self.pending_edits[request.merge_key]
+                self.sending_edits.add(request.merge_key)
+            args, kwargs = request.call
         
         try:
-            bot.edit_message_text(
-                chat_id=msg_data['chat_id'],
-                message_id=msg_data['message_id'],
-                text=new_status,
-                parse_mode='Markdown'
-            )
-            # Сохраняем последний отправленный текст
-            msg_data['last_edited_text'] = new_status
+            result = getattr(bot, request.method)(*args, **kwargs)
         except Exception as e:
-            logger.error(f"Error updating status: {e}")
+            retry_after = self._retry_after(e)
+            if retry_after is None or request.attempts >= self.max_retries:
+                self._complete(request, error=e)
+                return
+            request.attempts += 1
+            logger.warning(f"Telegram 429 on {request.method} (chat {request.chat_id}), retry in {retry_after}s")
+            if request.chat_id is None:
+                # Запрос без чата: flood-wait относится ко всему боту
+                self.global_bucket.pause(retry_after)
+            else:
+                self._chat_bucket(request.chat_id).pause(retry_after)
+            self._schedule(request, retry_after)
+            if request.merge_key:
+                self._edit_done(request)
+            return
+        self._complete(request, result=result)
+
+    def _complete(self, request, result=None, error=None):
+        if request.merge_key:
+            self._edit_done(request)
+        if error is not None:
+            request.future.set_exception(error)
+        else:
+            request.future.set_result(result)
+
+    @staticmethod
+    def _retry_after(error):
+        # ApiTelegramException (sync и asyncio-версии) с кодом 429 содержит parameters.retry_after
+        if getattr(error, 'error_code', None) != 429:
+            return None
+        parameters = (getattr(error, 'result_json', None) or {}).get('parameters') or {}
+        return parameters.get('retry_after', 1)
+
+    @staticmethod
+    def _chat_of(args, kwargs):
+        if 'chat_id' in kwargs:
+            return kwargs['chat_id']
+        if not args:
+            return None
+        target = args[0]
+        chat = getattr(target, 'chat', None)  # reply_to(message, ...)
+        return chat.id if chat is not None else target
+
+telegram = TelegramGateway(
+    TELEGRAM_SENDERS, TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST, TELEGRAM_MAX_RETRIES
+)
+
+# Функции для работы со статусными сообщениями
+# Шаблон статусного сообщения: текст собирается из состояния этапов
+STATUS_STEPS = (
+    ("metadata", "Извлечение метаданных"),
+    ("geolocation", "Поиск геолокации"),
+    ("location_analysis", "Анализ местоположения"),
+    ("manipulation_check", "Проверка на редактирование")
+)
+STATUS_SYMBOLS = {
+    "completed": "✅",
+    "failed": "❌",
+    "progress": "🔄",
+    "waiting": "⏳"
+}
+STATUS_HEADER = "🔍 *Анализ изображения начат...*"
+STATUS_FINISHED_HEADER = "✅ *Анализ успешно завершен!*"
+STATUS_TEMPLATE = "{header}\n\n{steps}\n\n_Подождите, это может занять некоторое время..._"
+STATUS_LINE = "• `{symbol}` {name}"
+STATUS_PENDING_LINES = {key: STATUS_LINE.format(symbol="[ ]", name=name) for key, name in STATUS_STEPS}
+
+def render_status(status):
+    """Собирает текст статуса по шаблону"""
+    lines = []
+    for key, name in STATUS_STEPS:
+        state = status.steps.get(key)
+        if state is None:
+            lines.append(STATUS_PENDING_LINES[key])
+            continue
+        step_status, detail = state
+        line = STATUS_LINE.format(symbol=STATUS_SYMBOLS.get(step_status, " "), name=name)
+        lines.append(f"{line} - {detail}" if detail else line)
+    header = STATUS_FINISHED_HEADER if status.finished else STATUS_HEADER
+    return STATUS_TEMPLATE.format(header=header, steps="\n".join(lines))
+
+def update_status_message(job, new_status):
+    """Отправляет текст статуса, только если он отличается от уже показанного"""
+    try:
+        status = job.status
+        if status is None or status.queued_text == new_status:
+            return
+        
+        # Не ждем отправки: шлюз сольет правку с более новой, если она не успела уйти
+        future = telegram.submit(
+            'edit_message_text',
+            chat_id=job.chat_id,
+            message_id=status.message_id,
+            text=new_status,
+            parse_mode='Markdown'
+        )
+        status.queued_text = new_status
+        future.add_done_callback(functools.partial(status_edit_done, status, new_status))
     except Exception as e:
         logger.error(f"Unexpected error in update_status_message: {e}")
 
-def create_status_message(user_id, chat_id):
+def status_edit_done(status, text, future):
+    """Запоминает текст, когда Telegram подтвердил правку (вызывается шлюзом по завершении)"""
+    # Без job.lock: колбэк может выполниться сразу в потоке, который уже держит блокировку
+    if future.exception():
+        logger.error(f"Error updating status: {future.exception()}")
+        if status.queued_text == text:
+            status.queued_text = status.last_edited_text  # Тот же текст можно отправить повторно
+        return
+    if future.result() is not None:  # None - правка заменена более новой и не отправлялась
+        status.last_edited_text = text
+
+def create_status_message(job):
     """Создает статусное сообщение"""
-    text = "🔍 *Анализ изображения начат...*\n\n"
-    text += "• `[ ]` Извлечение метаданных\n"
-    text += "• `[ ]` Поиск геолокации\n"
-    text += "• `[ ]` Анализ местоположения\n"
-    text += "• `[ ]` Проверка на редактирование\n\n"
-    text += "_Подождите, это может занять некоторое время..._"
+    status = StatusMessage()
+    text = render_status(status)
     
     try:
-        msg = bot.send_message(chat_id, text, parse_mode='Markdown')
-        user_data[user_id]['status_message'] = {
-            'chat_id': chat_id,
-            'message_id': msg.message_id,
-            'status': text,
-            'last_edited_text': text,
-            'last_update': time.time()
-        }
+        msg = telegram.send_message(job.chat_id, text, parse_mode='Markdown')
+        status.message_id = msg.message_id
+        status.queued_text = status.last_edited_text = text
+        job.status = status
         return msg.message_id
     except Exception as e:
         logger.error(f"Error creating status message: {e}")
         return None
 
-def update_status_step(user_id, step_name, status="progress", message=""):
-    """Обновляет конкретный шаг в статусном сообщении"""
-    if user_id not in user_data or 'status_message' not in user_data[user_id]:
+def update_status_step(job, step_name, status="progress", message=""):
+    """Обновляет состояние этапа; текст отправится при следующей отложенной правке"""
+    if job.status is None:
         return
     
-    status_data = user_data[user_id]['status_message']
+    with job.lock:
+        state = (status, message)
+        if job.status.steps.get(step_name) == state:
+            return
+        job.status.steps[step_name] = state
+    schedule_status_flush(job)
+
+def schedule_status_flush(job):
+    """Отправляет накопленные изменения статуса не чаще раза в STATUS_EDIT_INTERVAL"""
+    status = job.status
+    
+    with job.lock:
+        # Изменения уйдут вместе с уже запланированной отправкой
+        if status.flush_timer:
+            return
+        delay = status.last_update + STATUS_EDIT_INTERVAL - time.time()
+        if delay > 0:
+            timer = threading.Timer(delay, flush_status_message, args=(job,))
+            timer.daemon = True
+            status.flush_timer = timer
+            timer.start()
+            return
     
-    # Добавляем задержку между обновлениями
-    current_time = time.time()
-    if current_time - status_data['last_update'] < 0.5:
+    flush_status_message(job)
+
+def flush_status_message(job):
+    """Отправляет последнее накопленное состояние статуса"""
+    status = job.status
+    if status is None:
         return
     
-    status_symbols = {
-        "completed": "✅",
-        "failed": "❌",
-        "progress": "🔄",
-        "waiting": "⏳"
-    }
-    symbol = status_symbols.get(status, " ")
+    # Отправка ставится в очередь под блокировкой: иначе запоздавшая правка
+    # может уйти после итогового статуса
+    with job.lock:
+        status.flush_timer = None
+        if status.finished:
+            return  # Итоговый статус уже показан, промежуточный его не заменяет
+        status.last_update = time.time()
+        update_status_message(job, render_status(status))
+
+def finish_status_message(job):
+    """Отменяет отложенную отправку и сразу показывает итоговый статус"""
+    status = job.status
+    with job.lock:
+        if status.flush_timer:
+            status.flush_timer.cancel()
+            status.flush_timer = None
+        status.finished = True
+        status.last_update = time.time()
+        update_status_message(job, render_status(status))
+
+# Функции для анализа изображения
+ELA_JPEG_QUALITY = 90
+ELA_DOWNSCALE_ABOVE = 2048  # Изображения больше этого размера уменьшаются
+ELA_TARGET_SIDE = 1024
+ELA_TILE_SIZE = 32
+ELA_EDIT_THRESHOLD = 25
+ELA_REGION_SIGMA = 2.0  # Плитка подозрительна, если ее среднее выше среднего по плиткам на 2σ
+ELA_MAX_REGIONS = 10
+ELA_GRAY_WEIGHTS = np.array([0.299, 0.587, 0.114], dtype=np.float32)  # ITU-R 601-2, как convert("L")
+
+def compute_ela(original, compressed, tile_size=ELA_TILE_SIZE):
+    """Считает ELA по массивам RGB: растянутую разницу, оттенки серого и статистику по плиткам"""
+    # Работаем с каналами раздельно: непрерывные плоскости считаются в разы быстрее чередующихся
+    planes = []
+    gray = np.zeros(original.shape[:2], dtype=np.float32)
+    for channel in range(3):
+        diff = np.abs(original[..., channel].astype(np.int16) - compressed[..., channel]).astype(np.float32)
+        # Автоконтраст канала (аналог ImageOps.autocontrast без промежуточных изображений)
+        lo, hi = diff.min(), diff.max()
+        if hi > lo:
+            diff -= lo
+            diff *= 255.0 / (hi - lo)
+        plane = diff.astype(np.uint8)
+        gray += plane * ELA_GRAY_WEIGHTS[channel]
+        planes.append(plane)
+    stretched = np.dstack(planes)
     
-    steps = {
-        "metadata": "Извлечение метаданных",
-        "geolocation": "Поиск геолокации",
-        "location_analysis": "Анализ местоположения",
-        "manipulation_check": "Проверка на редактирование"
-    }
+    # Статистика по плиткам: суммы, квадраты и максимумы через reduceat (крайние плитки неполные)
+    height, width = gray.shape
+    rows = np.arange(0, height, tile_size)
+    cols = np.arange(0, width, tile_size)
+    sums = np.add.reduceat(np.add.reduceat(gray, rows, axis=0, dtype=np.float64), cols, axis=1)
+    squares = np.add.reduceat(np.add.reduceat(np.square(gray, dtype=np.float64), rows, axis=0), cols, axis=1)
+    maxes = np.maximum.reduceat(np.maximum.reduceat(gray, rows, axis=0), cols, axis=1)
+    counts = np.outer(np.diff(np.append(rows, height)), np.diff(np.append(cols, width)))
     
-    text = status_data['status']
-    for key, name in steps.items():
-        if key == step_name:
-            # Поиск существующей строки для обновления
-            pattern = re.compile(rf"•\s`\[.\]`\s{name}.*")
-            new_line = f"• `{symbol}` {name}"
-            if message:
-                new_line += f" - {message}"
-                
-            if pattern.search(text):
-                text = pattern.sub(new_line, text)
-            else:
-                text = text.replace(f"• `[ ]` {name}", new_line)
+    means = sums / counts
+    variances = np.maximum(squares / counts - means ** 2, 0)
+    return stretched, float(sums.sum() / gray.size), means, maxes, variances
+
+def find_suspicious_regions(means, maxes, tile_size, scale):
+    """Объединяет подозрительные соседние плитки в области (координаты исходного изображения)"""
+    threshold = max(float(means.mean() + ELA_REGION_SIGMA * means.std()), ELA_EDIT_THRESHOLD)
+    mask = means > threshold
+    seen = np.zeros_like(mask)
+    regions = []
+    
+    for start in zip(*np.nonzero(mask)):
+        if seen[start]:
+            continue
+        seen[start] = True
+        stack, tiles = [start], []
+        while stack:
+            row, col = stack.pop()
+            tiles.append((row, col))
+            for neighbour in ((row - 1, col), (row + 1, col), (row, col - 1), (row, col + 1)):
+                r, c = neighbour
+                if 0 <= r < mask.shape[0] and 0 <= c < mask.shape[1] and mask[r, c] and not seen[r, c]:
+                    seen[r, c] = True
+                    stack.append(neighbour)
+        
+        tile_rows, tile_cols = zip(*tiles)
+        regions.append({
+            'box': tuple(int(v * tile_size * scale) for v in (min(tile_cols), min(tile_rows), max(tile_cols) + 1, max(tile_rows) + 1)),
+            'tiles': len(tiles),
+            'mean': float(np.mean([means[t] for t in tiles])),
+            'max': float(max(maxes[t] for t in tiles))
+        })
     
-    user_data[user_id]['status_message']['status'] = text
-    user_data[user_id]['status_message']['last_update'] = current_time
-    update_status_message(user_id, text)
+    regions.sort(key=lambda region: region['mean'], reverse=True)
+    return regions[:ELA_MAX_REGIONS]
+
+def decode_image(image_bytes, target_side, downscale_above=None):
+    """Декодирует изображение в RGB, по возможности сразу в уменьшенном разрешении"""
+    image = Image.open(io.BytesIO(image_bytes))
+    full_size = image.size
+    
+    if max(full_size) > (downscale_above or target_side):
+        # JPEG: масштабирование на этапе DCT (1/2, 1/4, 1/8) - полный кадр не декодируется
+        image.draft("RGB", (target_side, target_side))
+        # Остальные форматы: целочисленное reduce() перед LANCZOS внутри thumbnail
+        image.thumbnail((target_side, target_side), Image.LANCZOS, reducing_gap=2.0)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return image, full_size
+
+def perceptual_hash(image_bytes):
+    """64-битный dHash: знаки разностей соседних пикселей в кадре 9x8 оттенков серого"""
+    image, _ = decode_image(image_bytes, 64)
+    pixels = np.asarray(image.convert("L").resize((9, 8), Image.BILINEAR), dtype=np.int16)
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+class NearDuplicateIndex:
+    """Мульти-индексная хэш-таблица по 64-битным хэшам (поиск по расстоянию Хэмминга)"""
+    ENTRY_OVERHEAD = 400  # Записи в OrderedDict и корзинах (замер tracemalloc), без данных
+
+    def __init__(self, max_distance, max_entries):
+        # Хэш режется на max_distance + 1 кусков: при расстоянии <= max_distance
+        # хотя бы один кусок совпадает точно, поэтому кандидаты берутся из корзин
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        chunks = max_distance + 1
+        widths = [64 // chunks + (1 if i < 64 % chunks else 0) for i in range(chunks)]
+        self.chunks = []
+        shift = 64
+        for width in widths:
+            shift -= width
+            self.chunks.append((shift, (1 << width) - 1))
+        self.buckets = [{} for _ in self.chunks]  # значение куска -> {id записи: хэш}
+        self.entries = OrderedDict()  # id -> (хэш, данные, размер); от старых к новым
+        self.memory_bytes = 0
+        self.next_id = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, value, data):
+        with self.lock:
+            entry_id = self.next_id
+            self.next_id += 1
+            size = self.ENTRY_OVERHEAD + estimate_size(data)
+            self.entries[entry_id] = (value, data, size)
+            self.memory_bytes += size
+            for (shift, mask), buckets in zip(self.chunks, self.buckets):
+                buckets.setdefault((value >> shift) & mask, {})[entry_id] = value
+            while len(self.entries) > self.max_entries:
+                self._remove(*self.entries.popitem(last=False))
+
+    def find(self, value):
+        """Ближайшая запись в пределах max_distance: (расстояние, данные) или None"""
+        best_distance, best_id = self.max_distance + 1, None
+        with self.lock:
+            # Запись может попасть в несколько корзин - на минимум это не влияет
+            for (shift, mask), buckets in zip(self.chunks, self.buckets):
+                bucket = buckets.get((value >> shift) & mask)
+                if not bucket:
+                    continue
+                for entry_id, other in bucket.items():
+                    distance = bin(value ^ other).count('1')
+                    if distance < best_distance:
+                        best_distance, best_id = distance, entry_id
+            if best_id is None:
+                return None
+            return best_distance, self.entries[best_id][1]
+
+    def shrink(self, excess):
+        """Удаляет самые старые записи, пока не освободит excess байт"""
+        with self.lock:
+            freed = 0
+            while self.entries and freed < excess:
+                entry_id, entry = self.entries.popitem(last=False)
+                self._remove(entry_id, entry)
+                freed += entry[2]
+            return freed
+
+    def _remove(self, entry_id, entry):
+        value = entry[0]
+        self.memory_bytes -= entry[2]
+        for (shift, mask), buckets in zip(self.chunks, self.buckets):
+            key = (value >> shift) & mask
+            bucket = buckets[key]
+            del bucket[entry_id]
+            if not bucket:
+                del buckets[key]
+
+phash_index = NearDuplicateIndex(PHASH_MAX_DISTANCE, PHASH_INDEX_SIZE)
+job_store.share_budget(phash_index)
 
-# Функции для анализа изображения
 def check_image_manipulation(image_bytes):
-    """Проверка признаков редактирования фото"""
+    """Проверка признаков редактирования фото (ELA с картой по плиткам)"""
     try:
-        original = Image.open(io.BytesIO(image_bytes))
-        
-        # Уменьшаем большие изображения для оптимизации
-        if max(original.size) > 2048:
-            original.thumbnail((1024, 1024), Image.LANCZOS)
+        # Большие изображения анализируем в уменьшенном виде
+        original, (full_width, _) = decode_image(image_bytes, ELA_TARGET_SIDE, ELA_DOWNSCALE_ABOVE)
         
         compressed_buffer = io.BytesIO()
-        original.save(compressed_buffer, "JPEG", quality=90)
+        original.save(compressed_buffer, "JPEG", quality=ELA_JPEG_QUALITY)
         compressed_buffer.seek(0)
         compressed = Image.open(compressed_buffer)
         
-        ela_image = ImageChops.difference(original, compressed)
-        ela_image = ImageOps.autocontrast(ela_image)
+        stretched, mean_intensity, means, maxes, variances = compute_ela(np.asarray(original), np.asarray(compressed))
+        scale = full_width / original.width
+        regions = find_suspicious_regions(means, maxes, ELA_TILE_SIZE, scale)
         
-        grayscale = ela_image.convert("L")
-        pixels = np.array(grayscale)
-        mean_intensity = np.mean(pixels)
+        # Отмечаем подозрительные области на ELA-изображении
+        ela_image = Image.fromarray(stretched)
+        draw = ImageDraw.Draw(ela_image)
+        for region in regions:
+            draw.rectangle([v / scale for v in region['box']], outline=(255, 0, 0), width=2)
         
         ela_buffer = io.BytesIO()
         ela_image.save(ela_buffer, format='JPEG')
         
         return {
             'ela_score': mean_intensity,
-            'is_edited': mean_intensity > 25,
-            'ela_image': ela_buffer.getvalue()
+            'is_edited': mean_intensity > ELA_EDIT_THRESHOLD,
+            'ela_image': ela_buffer.getvalue(),
+            'tile_size': ELA_TILE_SIZE,
+            'heatmap': means.astype(np.float32),
+            'tile_max': maxes,
+            'tile_variance': variances.astype(np.float32),
+            'regions': regions
         }
     except Exception as e:
         logger.error(f"ELA analysis failed: {e}")
@@ -301,74 +1501,399 @@ def extract_gps_from_exifread(tags):
     
     return None, None
 
-def extract_metadata_advanced(image_bytes):
-    """Извлекает метаданные всеми доступными способами"""
+# Единый парсер EXIF: один проход по структуре TIFF прямо из байтов
+EXIF_TYPE_FORMATS = {1: "B", 3: "H", 4: "L", 5: "L", 6: "b", 8: "h", 9: "l", 10: "l", 11: "f", 12: "d"}
+EXIF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8}
+EXIF_RATIONAL_TYPES = (5, 10)
+EXIF_SUB_IFDS = {
+    "0th": {0x8769: "Exif", 0x8825: "GPS"},
+    "Exif": {0xA005: "Interop"},
+}
+EXIFREAD_GROUPS = {
+    "0th": ("Image", EXIFREAD_TAGS),
+    "Exif": ("EXIF", EXIFREAD_TAGS),
+    "GPS": ("GPS", EXIFREAD_GPS_TAGS),
+    "Interop": ("Interoperability", EXIFREAD_INTEROP_TAGS),
+    "1st": ("Thumbnail", EXIFREAD_TAGS),
+}
+EXIF_SKIPPED_TAGS = {0x927C}  # MakerNote: проприетарный бинарный блок
+EXIF_SCAN_LIMIT = 512 * 1024  # Для HEIC и прочих контейнеров ищем EXIF в начале файла
+
+def find_exif_block(image_bytes):
+    """Находит TIFF-блок EXIF внутри контейнера без копирования данных"""
+    data = memoryview(image_bytes)
+    size = len(data)
+
+    if data[:2] == b"\xff\xd8":  # JPEG: идем по маркерам до начала скана
+        pos = 2
+        while pos + 4 <= size:
+            if data[pos] != 0xFF:
+                return None
+            marker = data[pos + 1]
+            if marker == 0xFF:
+                pos += 1
+                continue
+            if marker in (0xD9, 0xDA):
+                return None
+            if 0xD0 <= marker <= 0xD7 or marker == 0x01:
+                pos += 2
+                continue
+            segment_length = struct.unpack_from(">H", data, pos + 2)[0]
+            if marker == 0xE1 and data[pos + 4:pos + 10] == b"Exif\x00\x00":
+                return data[pos + 10:pos + 2 + segment_length]
+            pos += 2 + segment_length
+        return None
+
+    if data[:4] in (b"II*\x00", b"MM\x00*"):  # TIFF
+        return data
+
+    if data[:8] == b"\x89PNG\r\n\x1a\n":  # PNG: чанк eXIf
+        pos = 8
+        while pos + 8 <= size:
+            chunk_length = struct.unpack_from(">L", data, pos)[0]
+            chunk_type = data[pos + 4:pos + 8]
+            if chunk_type == b"eXIf":
+                return data[pos + 8:pos + 8 + chunk_length]
+            if chunk_type == b"IEND":
+                return None
+            pos += 12 + chunk_length
+        return None
+
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":  # WebP: чанк EXIF
+        pos = 12
+        while pos + 8 <= size:
+            chunk_length = struct.unpack_from("<L", data, pos + 4)[0]
+            if data[pos:pos + 4] == b"EXIF":
+                chunk = data[pos + 8:pos + 8 + chunk_length]
+                return chunk[6:] if chunk[:6] == b"Exif\x00\x00" else chunk
+            pos += 8 + chunk_length + (chunk_length & 1)
+        return None
+
+    # HEIC и прочие контейнеры: ищем заголовок Exif в начале файла
+    idx = bytes(data[:EXIF_SCAN_LIMIT]).find(b"Exif\x00\x00")
+    if idx != -1 and data[idx + 6:idx + 10] in (b"II*\x00", b"MM\x00*"):
+        return data[idx + 6:]
+    return None
+
+def metadata_region_end(image_bytes):
+    """Возвращает длину заголовочной части файла, где лежат метаданные контейнера"""
+    if image_bytes[:2] == b"\xff\xd8":
+        # JPEG: все метаданные находятся в сегментах до начала скана (SOS)
+        pos = 2
+        while pos + 4 <= len(image_bytes):
+            marker = image_bytes[pos + 1]
+            if image_bytes[pos] != 0xFF or marker in (0xD9, 0xDA):
+                if marker == 0xDA:
+                    pos += 2 + struct.unpack_from(">H", image_bytes, pos + 2)[0]
+                return pos
+            if marker == 0xFF:
+                pos += 1
+                continue
+            if 0xD0 <= marker <= 0xD7 or marker == 0x01:
+                pos += 2
+                continue
+            pos += 2 + struct.unpack_from(">H", image_bytes, pos + 2)[0]
+    # Остальные форматы могут хранить метаданные после данных изображения
+    return len(image_bytes)
+
+def read_exif_value(tiff, endian, value_type, count, entry_pos):
+    """Читает значение тега в формате piexif (байты, числа, дроби-кортежи)"""
+    size = EXIF_TYPE_SIZES.get(value_type)
+    if size is None:
+        return None
+
+    total = size * count
+    if total > 4:
+        offset = struct.unpack_from(endian + "L", tiff, entry_pos)[0]
+    else:
+        offset = entry_pos
+    if offset + total > len(tiff):
+        return None
+
+    if value_type == 2:  # ASCII, без завершающего нуля
+        return bytes(tiff[offset:offset + max(count - 1, 0)])
+    if value_type == 7:  # UNDEFINED
+        return bytes(tiff[offset:offset + total])
+
+    values_count = count * 2 if value_type in EXIF_RATIONAL_TYPES else count
+    values = struct.unpack_from(f"{endian}{values_count}{EXIF_TYPE_FORMATS[value_type]}", tiff, offset)
+    if value_type in EXIF_RATIONAL_TYPES:
+        values = tuple(zip(values[0::2], values[1::2]))
+    return values[0] if len(values) == 1 else values
+
+def parse_exif(image_bytes):
+    """Разбирает все IFD (0th, Exif, GPS, Interop, 1st) за один проход"""
+    tiff = find_exif_block(image_bytes)
+    if tiff is None or len(tiff) < 8:
+        return {}
+
+    byte_order = bytes(tiff[:2])
+    if byte_order == b"II":
+        endian = "<"
+    elif byte_order == b"MM":
+        endian = ">"
+    else:
+        return {}
+
+    exif = {}
+    visited = set()
+    pending = [("0th", struct.unpack_from(endian + "L", tiff, 4)[0])]
+
+    while pending:
+        ifd_name, offset = pending.pop(0)
+        if offset in visited or offset + 2 > len(tiff):
+            continue
+        visited.add(offset)
+
+        entries = struct.unpack_from(endian + "H", tiff, offset)[0]
+        ifd = exif.setdefault(ifd_name, {})
+        pos = offset + 2
+        for _ in range(entries):
+            if pos + 12 > len(tiff):
+                break
+            tag, value_type, count = struct.unpack_from(endian + "HHL", tiff, pos)
+            value = read_exif_value(tiff, endian, value_type, count, pos + 8)
+            if value is not None:
+                ifd[tag] = (value_type, value)
+                sub_ifd = EXIF_SUB_IFDS.get(ifd_name, {}).get(tag)
+                if sub_ifd and isinstance(value, int):
+                    pending.append((sub_ifd, value))
+            pos += 12
+
+        if ifd_name == "0th" and pos + 4 <= len(tiff):
+            next_ifd = struct.unpack_from(endian + "L", tiff, pos)[0]
+            if next_ifd:
+                pending.append(("1st", next_ifd))
+
+    return {name: tags for name, tags in exif.items() if tags}
+
+def format_exif_value(value_type, value):
+    """Форматирует значение тега для отчета"""
+    if isinstance(value, tuple) and not value:
+        return ""  # Тег с count = 0
+    if value_type in (2, 7):
+        text = value.decode("utf-8", "replace").strip("\x00 ")
+        if value_type == 7 and (len(value) > 64 or not text.isprintable()):
+            return f"<двоичные данные, {len(value)} байт>"
+        return text
+
+    if value_type in EXIF_RATIONAL_TYPES:
+        pairs = value if isinstance(value[0], tuple) else (value,)
+        parts = [str(n) if d == 1 else f"{n}/{d}" for n, d in pairs]
+        return parts[0] if len(parts) == 1 else f"[{', '.join(parts)}]"
+
+    if isinstance(value, tuple):
+        return f"[{', '.join(str(v) for v in value)}]"
+    return str(value)
+
+def exif_tag_name(ifd_name, tag):
+    """Возвращает имя тега по таблицам piexif"""
+    table = piexif.TAGS["Image" if ifd_name in ("0th", "1st") else ifd_name]
+    return table[tag]["name"] if tag in table else f"Tag0x{tag:04X}"
+
+def exif_to_metadata(exif):
+    """Раскладывает результат parse_exif по ключам отчета"""
+    metadata = {}
+
+    for ifd_name, tags in exif.items():
+        group, exifread_table = EXIFREAD_GROUPS[ifd_name]
+        for tag, (value_type, value) in tags.items():
+            if tag in EXIF_SKIPPED_TAGS:
+                continue
+            text = format_exif_value(value_type, value)
+
+            if METADATA_KEY_MODE == "merged":
+                metadata[f"Exif_{ifd_name}_{exif_tag_name(ifd_name, tag)}"] = text
+                continue
+
+            # Pillow: объединенный словарь 0th + Exif, GPS вложен в GPSInfo
+            if ifd_name in ("0th", "Exif") and not (ifd_name == "0th" and tag == 0x8825):
+                metadata[f"Pillow_{TAGS.get(tag, tag)}"] = text
+
+            # ExifRead: "Группа Имя", перечисления раскрываются в названия
+            if tag in exifread_table:
+                name, *values_map = exifread_table[tag]
+                exifread_text = text
+                if values_map and isinstance(values_map[0], dict) and isinstance(value, int):
+                    exifread_text = values_map[0].get(value, text)
+                metadata[f"ExifRead_{group} {name}"] = exifread_text
+
+            # piexif: только известные теги, значение в исходном виде
+            piexif_name = exif_tag_name(ifd_name, tag)
+            if not piexif_name.startswith("Tag0x"):
+                metadata[f"Piexif_{ifd_name}_{piexif_name}"] = str(value)
+
+    if METADATA_KEY_MODE != "merged" and "GPS" in exif:
+        gps_info = {GPSTAGS.get(tag, tag): format_exif_value(*item) for tag, item in exif["GPS"].items()}
+        metadata["Pillow_GPSInfo"] = str(gps_info)
+
+    return metadata
+
+def extract_gps_from_ifd(exif):
+    """Извлекает GPS координаты из результата parse_exif"""
+    try:
+        gps = exif.get("GPS", {})
+        if 2 in gps and 4 in gps:
+            lat = convert_to_degrees(gps[2][1])
+            lon = convert_to_degrees(gps[4][1])
+
+            if lat is None or lon is None:
+                return None, None
+
+            lat_ref = gps.get(1, (2, b"N"))[1]
+            lon_ref = gps.get(3, (2, b"E"))[1]
+            if lat_ref.strip() == b"S": lat = -lat
+            if lon_ref.strip() == b"W": lon = -lon
+
+            return lat, lon
+    except Exception as e:
+        logger.error(f"IFD GPS extraction error: {e}")
+
+    return None, None
+
+def extract_gps(image_bytes):
+    """Быстро извлекает только GPS координаты (без остальных метаданных)"""
+    return extract_gps_from_ifd(parse_exif(image_bytes))
+
+def extract_metadata_legacy(image_bytes):
+    """Старый каскад Pillow + exifread + piexif (для сверки)"""
+    metadata = {}
+    image_stream = io.BytesIO(image_bytes)
+    image = Image.open(image_stream)
+
+    exif_data = image._getexif() or {}
+    for tag_id, value in exif_data.items():
+        tag = TAGS.get(tag_id, tag_id)
+        metadata[f"Pillow_{tag}"] = str(value)
+    lat, lon = extract_gps_from_exif(exif_data)
+
+    image_stream.seek(0)
+    tags = exifread.process_file(image_stream, details=False)
+    for tag, value in tags.items():
+        if tag not in ('JPEGThumbnail', 'TIFFThumbnail', 'Filename', 'EXIF MakerNote'):
+            metadata[f"ExifRead_{tag}"] = str(value)
+    if lat is None or lon is None:
+        lat, lon = extract_gps_from_exifread(tags)
+
+    try:
+        exif_dict = piexif.load(image_bytes)
+    except Exception as piexif_e:
+        logger.warning(f"Piexif extraction warning: {piexif_e}")
+        exif_dict = {}
+    for ifd in exif_dict:
+        if ifd != "thumbnail":
+            for tag, value in exif_dict[ifd].items():
+                tag_name = piexif.TAGS[ifd][tag]["name"]
+                metadata[f"Piexif_{ifd}_{tag_name}"] = str(value)
+
+    return metadata, lat, lon, exif_dict
+
+def normalize_metadata_value(value):
+    """Приводит значение отчета к сравнимому виду: числа к float, байты к формату парсера, GPS-ключи к именам"""
+    if isinstance(value, str):
+        try:
+            value = ast.literal_eval(value)
+        except (ValueError, SyntaxError, MemoryError, RecursionError):
+            if value.startswith("[") and value.endswith("]"):
+                return tuple(normalize_metadata_value(part) for part in value[1:-1].split(", "))
+            try:
+                return round(float(Fraction(value)), 9)
+            except (ValueError, ZeroDivisionError):
+                return value
+    if isinstance(value, bytes):
+        return normalize_metadata_value(format_exif_value(7, value))
+    if isinstance(value, dict):
+        return {GPSTAGS.get(key, key): normalize_metadata_value(item) for key, item in value.items()}
+    if isinstance(value, (tuple, list)):
+        return tuple(normalize_metadata_value(item) for item in value)
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return round(float(value), 9)
+    return value
+
+def compare_with_legacy_metadata(image_bytes, exif, metadata, lat, lon):
+    """Сверяет результат единого парсера со старым каскадом библиотек"""
+    diff = {'missing_keys': [], 'value_mismatches': [], 'gps_mismatch': None}
+    try:
+        legacy_metadata, legacy_lat, legacy_lon, exif_dict = extract_metadata_legacy(image_bytes)
+    except Exception as e:
+        logger.warning(f"Legacy metadata extraction failed: {e}")
+        return diff
+
+    # Сырые значения сравниваем с piexif один к одному
+    for ifd_name, tags in exif_dict.items():
+        if ifd_name == "thumbnail":
+            continue
+        parsed = exif.get(ifd_name, {})
+        for tag, value in tags.items():
+            if tag not in parsed or parsed[tag][1] != value:
+                diff['value_mismatches'].append(f"{ifd_name}:{exif_tag_name(ifd_name, tag)}")
+
+    if METADATA_KEY_MODE != "merged":
+        # Намеренно пропущенные теги (MakerNote) расхождением не считаем
+        skipped_keys = set()
+        for tag in EXIF_SKIPPED_TAGS:
+            skipped_keys.add(f"Pillow_{TAGS.get(tag, tag)}")
+            skipped_keys.update(f"Piexif_{ifd_name}_{exif_tag_name(ifd_name, tag)}" for ifd_name in exif_dict
+                                if ifd_name != "thumbnail")
+        diff['missing_keys'] = sorted(set(legacy_metadata) - set(metadata) - skipped_keys)
+
+        # Отформатированные значения сравниваем после нормализации
+        for key in sorted(set(legacy_metadata) & set(metadata)):
+            if not key.startswith(("Pillow_", "ExifRead_")):
+                continue
+            text = metadata[key]
+            # exifread раскрывает часть бинарных тегов, мы намеренно показываем заглушку
+            if key.startswith("ExifRead_") and text.startswith("<двоичные данные"):
+                continue
+            if normalize_metadata_value(legacy_metadata[key]) != normalize_metadata_value(text):
+                diff['value_mismatches'].append(key)
+
+    if (legacy_lat is None) != (lat is None) or (
+            lat is not None and (abs(legacy_lat - lat) > 1e-6 or abs(legacy_lon - lon) > 1e-6)):
+        diff['gps_mismatch'] = ((legacy_lat, legacy_lon), (lat, lon))
+
+    if diff['missing_keys'] or diff['value_mismatches'] or diff['gps_mismatch']:
+        logger.warning(f"Metadata compat check differences: {diff}")
+    return diff
+
+def extract_metadata_advanced(image_bytes, exif=None):
+    """Извлекает метаданные: EXIF за один проход (или уже разобранный) + не-EXIF данные через hachoir"""
     metadata = {}
     lat, lon = None, None
     extracted_count = 0
     
     try:
-        # 1. Метод 1: Используем Pillow (EXIF)
-        image_stream = io.BytesIO(image_bytes)
-        image = Image.open(image_stream)
-        
-        # EXIF через Pillow
-        exif_data = image._getexif() or {}
-        for tag_id, value in exif_data.items():
-            tag = TAGS.get(tag_id, tag_id)
-            metadata[f"Pillow_{tag}"] = str(value)
-            extracted_count += 1
-        
-        # GPS через Pillow
-        lat, lon = extract_gps_from_exif(exif_data)
-        
-        # 2. Метод 2: Используем exifread
-        image_stream.seek(0)
-        tags = exifread.process_file(image_stream, details=False)
-        for tag, value in tags.items():
-            if tag not in ('JPEGThumbnail', 'TIFFThumbnail', 'Filename', 'EXIF MakerNote'):
-                metadata[f"ExifRead_{tag}"] = str(value)
-                extracted_count += 1
-        
-        # GPS через exifread (если не нашли через Pillow)
-        if lat is None or lon is None:
-            lat, lon = extract_gps_from_exifread(tags)
+        # 1. EXIF: единый проход по IFD прямо из байтов
+        if exif is None:
+            exif = parse_exif(image_bytes)
+        exif_metadata = exif_to_metadata(exif)
+        metadata.update(exif_metadata)
+        extracted_count += len(exif_metadata)
+        lat, lon = extract_gps_from_ifd(exif)
+
+        if METADATA_COMPAT_CHECK:
+            compare_with_legacy_metadata(image_bytes, exif, exif_metadata, lat, lon)
         
-        # 3. Метод 3: Используем piexif
-        try:
-            image_stream.seek(0)
-            exif_dict = piexif.load(image_stream.getvalue())
-            for ifd in exif_dict:
-                if ifd != "thumbnail":
-                    for tag, value in exif_dict[ifd].items():
-                        tag_name = piexif.TAGS[ifd][tag]["name"]
-                        metadata[f"Piexif_{ifd}_{tag_name}"] = str(value)
-                        extracted_count += 1
-        except Exception as piexif_e:
-            logger.warning(f"Piexif extraction warning: {piexif_e}")
-        
-        # 4. Метод 4: Используем hachoir (для не-EXIF метаданных)
+        # 2. Используем hachoir (для не-EXIF метаданных) прямо из памяти
         try:
-            with tempfile.NamedTemporaryFile(delete=False) as tmp_file:
-                tmp_file.write(image_bytes)
-                tmp_file.flush()
-                parser = createParser(tmp_file.name)
-                if parser:
-                    with parser:
-                        hachoir_metadata = extractMetadata(parser)
-                        if hachoir_metadata:
-                            for line in hachoir_metadata.exportPlaintext():
-                                key_val = line.split(":", 1)
-                                if len(key_val) == 2:
-                                    key = key_val[0].strip()
-                                    val = key_val[1].strip()
-                                    metadata[f"Hachoir_{key}"] = val
-                                    extracted_count += 1
-            os.unlink(tmp_file.name)
+            header = image_bytes[:metadata_region_end(image_bytes)]
+            parser = guessParser(InputIOStream(io.BytesIO(header), source="<upload>", tags=[]))
+            if parser:
+                with parser:
+                    hachoir_metadata = extractMetadata(parser)
+                    if hachoir_metadata:
+                        for line in hachoir_metadata.exportPlaintext():
+                            key_val = line.split(":", 1)
+                            if len(key_val) == 2:
+                                key = key_val[0].strip()
+                                val = key_val[1].strip()
+                                metadata[f"Hachoir_{key}"] = val
+                                extracted_count += 1
         except Exception as hachoir_e:
             logger.warning(f"Hachoir extraction warning: {hachoir_e}")
         
-        # 5. Метод 5: Анализ самого изображения
+        # 3. Анализ самого изображения (Pillow читает только заголовок)
+        image = Image.open(io.BytesIO(image_bytes))
         metadata["Image_Width"] = str(image.width)
         metadata["Image_Height"] = str(image.height)
         metadata["Image_Mode"] = str(image.mode)
@@ -381,41 +1906,11 @@ def extract_metadata_advanced(image_bytes):
     return metadata, lat, lon, extracted_count
 
 # Функции генерации отчета
-def generate_html_report(metadata, lat=None, lon=None, address=None, 
-                        landmark=None, manipulation_check=None):
-    """Генерирует интерактивный HTML отчет"""
-    # Генерация карты
-    map_html = ""
-    if lat and lon:
-        m = folium.Map(location=[lat, lon], zoom_start=15, tiles='cartodbpositron')
-        folium.Marker(
-            [lat, lon],
-            popup="Место съемки",
-            icon=folium.Icon(color='red', icon='camera', prefix='fa')
-        ).add_to(m)
-        
-        # Добавляем слой спутниковых снимков
-        folium.TileLayer(
-            tiles='https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}',
-            attr='Esri',
-            name='Спутниковый снимок',
-            overlay=False,
-            control=True
-        ).add_to(m)
-        
-        # Добавляем контроль слоев
-        folium.LayerControl().add_to(m)
-        
-        with tempfile.NamedTemporaryFile(suffix='.html', delete=False) as temp_file:
-            map_path = temp_file.name
-            m.save(map_path)
-        
-        with open(map_path, 'r', encoding='utf-8') as f:
-            map_html = f.read()
-        os.unlink(map_path)
-    
-    # Генерация HTML
-    html_content = f"""
+REPORT_METADATA_ROWS = 50
+REPORT_TIMESTAMP = "%GENERATED_AT%"  # Метка времени в кэшируемых отчетах, заменяется при отправке
+
+# Шаблон отчета: статические части разбираются и кодируются один раз при импорте
+REPORT_TEMPLATE = """
 <!DOCTYPE html>
 <html lang="ru">
 <head>
@@ -903,7 +2398,7 @@ def generate_html_report(metadata, lat=None, lon=None, address=None,
                     <div class="summary-icon">
                         <i class="fas fa-database"></i>
                     </div>
-                    <div class="summary-value">{len(metadata)}</div>
+                    <div class="summary-value">{metadata_count}</div>
                     <div class="summary-label">Метаданных извлечено</div>
                 </div>
                 
@@ -911,7 +2406,7 @@ def generate_html_report(metadata, lat=None, lon=None, address=None,
                     <div class="summary-icon">
                         <i class="fas fa-map-marked-alt"></i>
                     </div>
-                    <div class="summary-value">{"Да" if lat and lon else "Нет"}</div>
+                    <div class="summary-value">{has_gps}</div>
                     <div class="summary-label">Геоданные найдены</div>
                 </div>
                 
@@ -919,7 +2414,7 @@ def generate_html_report(metadata, lat=None, lon=None, address=None,
                     <div class="summary-icon">
                         <i class="fas fa-edit"></i>
                     </div>
-                    <div class="summary-value">{"Да" if manipulation_check and manipulation_check['is_edited'] else "Нет"}</div>
+                    <div class="summary-value">{is_edited}</div>
                     <div class="summary-label">Признаки редактирования</div>
                 </div>
             </div>
@@ -942,7 +2437,7 @@ def generate_html_report(metadata, lat=None, lon=None, address=None,
                                 </tr>
                             </thead>
                             <tbody>
-                                {"".join(f'<tr><td>{html.escape(k)}</td><td>{html.escape(str(v))}</td></tr>' for k, v in list(metadata.items())[:50])}
+                                {metadata_rows}
                             </tbody>
                         </table>
                     </div>
@@ -953,17 +2448,19 @@ def generate_html_report(metadata, lat=None, lon=None, address=None,
                 <i class="fas fa-search"></i> Анализ на редактирование
             </h2>
             
-            {generate_manipulation_section(manipulation_check)}
+            {manipulation_section}
             
             <h2 class="section-title fade-in delay-2">
                 <i class="fas fa-map-marker-alt"></i> Геолокация
             </h2>
             
-            {generate_location_section(lat, lon, address, landmark, map_html)}
+            {location_section}
+            
+            {provenance_section}
         </div>
         
         <div class="timestamp fade-in delay-3">
-            Отчет сгенерирован: {datetime.now().strftime('%d.%m.%Y %H:%M:%S')} | Image Analyzer Bot v3.0
+            Отчет сгенерирован: {generated_at} | Image Analyzer Bot v3.0
         </div>
     </div>
     
@@ -971,8 +2468,7 @@ def generate_html_report(metadata, lat=None, lon=None, address=None,
     <script>
         // Анимация прогресс-бара
         document.addEventListener('DOMContentLoaded', function() {{
-            const progressBar = document.getElementById('ela-progress');
-            if (progressBar) {{
+            document.querySelectorAll('.progress-bar[data-progress]').forEach(progressBar => {{
                 const width = progressBar.getAttribute('data-progress');
                 let currentWidth = 0;
                 
@@ -984,7 +2480,7 @@ def generate_html_report(metadata, lat=None, lon=None, address=None,
                         progressBar.style.width = currentWidth + '%';
                     }}
                 }}, 20);
-            }}
+            }});
             
             // Анимация появления элементов
             const fadeElements = document.querySelectorAll('.fade-in');
@@ -1005,9 +2501,220 @@ def generate_html_report(metadata, lat=None, lon=None, address=None,
 </body>
 </html>
 """
-    return html_content
 
-def generate_manipulation_section(manipulation_check):
+def compile_report_template(template):
+    """Разбивает шаблон на пары (статические байты, имя динамического поля)"""
+    return [
+        (literal.encode('utf-8'), field)
+        for literal, field, _, _ in string.Formatter().parse(template)
+    ]
+
+REPORT_PARTS = compile_report_template(REPORT_TEMPLATE)
+
+# Встроенный шаблон карты Leaflet: подставляются только координаты
+LEAFLET_MAP_TEMPLATE = """
+<link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css">
+<script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
+<div id="report-map" style="width: 100%; height: 100%;"></div>
+<script>
+    (function() {{
+        var map = L.map('report-map').setView([{lat}, {lon}], {zoom});
+        var streets = L.tileLayer('https://{{s}}.basemaps.cartocdn.com/light_all/{{z}}/{{x}}/{{y}}{{r}}.png', {{
+            attribution: '&copy; OpenStreetMap contributors &copy; CARTO',
+            maxZoom: 20
+        }}).addTo(map);
+        var satellite = L.tileLayer('https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{{z}}/{{y}}/{{x}}', {{
+            attribution: 'Esri'
+        }});
+        L.control.layers({{'Карта': streets, 'Спутниковый снимок': satellite}}).addTo(map);
+        var markers = {markers};
+        markers.forEach(function(marker) {{
+            L.marker([marker[0], marker[1]]).addTo(map).bindPopup(marker[2]);
+        }});
+        if (markers.length > 1) {{
+            map.fitBounds(markers.map(function(marker) {{ return [marker[0], marker[1]]; }}), {{padding: [30, 30]}});
+        }}
+    }})();
+</script>
+"""
+
+def render_leaflet_map(lat, lon, zoom, markers=None):
+    """Заполняет встроенный шаблон Leaflet (без folium); markers - [(широта, долгота, подпись)]"""
+    markers = markers or [(lat, lon, "Место съемки")]
+    markers = json.dumps([list(marker) for marker in markers], ensure_ascii=False).replace("</", "<\\/")
+    return LEAFLET_MAP_TEMPLATE.format(lat=lat, lon=lon, zoom=zoom, markers=markers)
+
+def render_folium_map(lat, lon, zoom, markers=None):
+    """Рендерит карту folium сразу в строку, без временного файла"""
+    markers = markers or [(lat, lon, "Место съемки")]
+    m = folium.Map(location=[lat, lon], zoom_start=zoom, tiles='cartodbpositron')
+    for marker_lat, marker_lon, label in markers:
+        folium.Marker(
+            [marker_lat, marker_lon],
+            popup=label,
+            icon=folium.Icon(color='red', icon='camera', prefix='fa')
+        ).add_to(m)
+    if len(markers) > 1:
+        m.fit_bounds([[marker_lat, marker_lon] for marker_lat, marker_lon, _ in markers])
+    
+    # Добавляем слой спутниковых снимков
+    folium.TileLayer(
+        tiles='https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}',
+        attr='Esri',
+        name='Спутниковый снимок',
+        overlay=False,
+        control=True
+    ).add_to(m)
+    
+    # Добавляем контроль слоев
+    folium.LayerControl().add_to(m)
+    return m.get_root().render()
+
+def generate_map_html(lat, lon, zoom=MAP_ZOOM):
+    """Генерирует HTML карты с местом съемки (с кэшем по ячейке координат)"""
+    # Ячейка: координаты, округленные до MAP_CACHE_PRECISION знаков (5 знаков ~ 1 м)
+    lat, lon = round(lat, MAP_CACHE_PRECISION), round(lon, MAP_CACHE_PRECISION)
+    cache_key = (MAP_RENDERER, lat, lon, zoom)
+    
+    with cache_lock:
+        if cache_key in map_cache:
+            return map_cache[cache_key]
+    
+    if MAP_RENDERER == "folium":
+        map_html = render_folium_map(lat, lon, zoom)
+    else:
+        map_html = render_leaflet_map(lat, lon, zoom)
+    
+    with cache_lock:
+        map_cache[cache_key] = map_html
+    return map_html
+
+def generate_album_map_html(markers, zoom=MAP_ZOOM):
+    """HTML карты с метками всех фото альбома (без кэша: набор точек уникален)"""
+    lat = sum(marker[0] for marker in markers) / len(markers)
+    lon = sum(marker[1] for marker in markers) / len(markers)
+    if MAP_RENDERER == "folium":
+        return render_folium_map(lat, lon, zoom, markers)
+    return render_leaflet_map(lat, lon, zoom, markers)
+
+def write_metadata_rows(out, metadata):
+    """Потоково записывает строки таблицы метаданных"""
+    for k, v in itertools.islice(metadata.items(), REPORT_METADATA_ROWS):
+        out.write(f'<tr><td>{html.escape(str(k))}</td><td>{html.escape(str(v))}</td></tr>'.encode('utf-8'))
+
+def write_html_report(out, metadata, lat=None, lon=None, address=None,
+                      landmark=None, manipulation_check=None, provenance=None, embed_ela=False,
+                      generated_at=None):
+    """Потоково записывает интерактивный HTML отчет в бинарный поток"""
+    map_html = generate_map_html(lat, lon) if lat and lon else ""
+    
+    fields = {
+        'metadata_count': str(len(metadata)),
+        'has_gps': "Да" if lat and lon else "Нет",
+        'is_edited': "Да" if manipulation_check and manipulation_check['is_edited'] else "Нет",
+        'metadata_rows': lambda: write_metadata_rows(out, metadata),
+        'manipulation_section': lambda: generate_manipulation_section(manipulation_check, embed_ela),
+        'location_section': lambda: generate_location_section(
+            lat, lon, address, landmark, map_html, bool(provenance and provenance.get('location_inherited'))
+        ),
+        'provenance_section': lambda: generate_provenance_section(provenance),
+        'generated_at': generated_at or datetime.now().strftime('%d.%m.%Y %H:%M:%S')
+    }
+    return write_report_parts(out, fields)
+
+def stamp_report(report):
+    """Подставляет время отправки в отчет, сохраненный в кэше с меткой REPORT_TIMESTAMP"""
+    return report.replace(REPORT_TIMESTAMP.encode('utf-8'), datetime.now().strftime('%d.%m.%Y %H:%M:%S').encode('utf-8'))
+
+def write_report_parts(out, fields):
+    """Заполняет предкомпилированный шаблон; вызываемые поля пишут в поток сами"""
+    for literal, field in REPORT_PARTS:
+        out.write(literal)
+        if field is None:
+            continue
+        value = fields[field]
+        if callable(value):
+            value = value()
+        if value:
+            out.write(value.encode('utf-8'))
+    return out
+
+def write_album_report(out, results, embed_ela=False):
+    """Потоково записывает общий отчет по альбому (тот же шаблон, секции по каждому фото)"""
+    photos = [(f"Фото {index}", result) for index, result in enumerate(results, 1)]
+    analysed = [(name, result) for name, result in photos if 'rejection' not in result]
+    located = [(name, result) for name, result in analysed if result['lat'] and result['lon']]
+    edited = sum(1 for _, result in analysed if result['manipulation_check'] and result['manipulation_check']['is_edited'])
+    
+    def write_rows():
+        for name, result in photos:
+            out.write(f'<tr><th colspan="2">{name}</th></tr>'.encode('utf-8'))
+            if 'rejection' in result:
+                out.write(f'<tr><td colspan="2">{html.escape(result["rejection"])}</td></tr>'.encode('utf-8'))
+            else:
+                write_metadata_rows(out, result['metadata'])
+    
+    def manipulation_sections():
+        return "".join(
+            f'<h3 class="mt-4">{name}</h3>' + (
+                generate_manipulation_section(result['manipulation_check'], embed_ela)
+                if 'rejection' not in result else f'<p>{html.escape(result["rejection"])}</p>'
+            )
+            for name, result in photos
+        )
+    
+    fields = {
+        'metadata_count': str(sum(len(result['metadata']) for _, result in analysed)),
+        'has_gps': f"{len(located)} из {len(photos)}",
+        'is_edited': f"{edited} из {len(photos)}",
+        'metadata_rows': write_rows,
+        'manipulation_section': manipulation_sections,
+        'location_section': lambda: generate_album_location_section(located),
+        'provenance_section': lambda: "".join(generate_provenance_section(result.get('provenance')) for _, result in analysed),
+        'generated_at': datetime.now().strftime('%d.%m.%Y %H:%M:%S')
+    }
+    return write_report_parts(out, fields)
+
+def render_album_report(results, embed_ela=False):
+    """Рендерит общий отчет по альбому в BytesIO"""
+    out = io.BytesIO()
+    write_album_report(out, results, embed_ela)
+    out.seek(0)
+    return out
+
+def render_html_report(metadata, lat=None, lon=None, address=None,
+                       landmark=None, manipulation_check=None, provenance=None, embed_ela=False,
+                       generated_at=None):
+    """Рендерит отчет в BytesIO, готовый к отправке"""
+    out = io.BytesIO()
+    write_html_report(out, metadata, lat, lon, address, landmark, manipulation_check, provenance, embed_ela,
+                      generated_at)
+    out.seek(0)
+    return out
+
+def generate_html_report(metadata, lat=None, lon=None, address=None, 
+                        landmark=None, manipulation_check=None, provenance=None):
+    """Генерирует интерактивный HTML отчет"""
+    return render_html_report(metadata, lat, lon, address, landmark, manipulation_check, provenance).getvalue().decode('utf-8')
+
+def ela_data_uri(ela_image):
+    """Перекодирует ELA-изображение в WebP и возвращает data URI для встраивания в отчет"""
+    out = io.BytesIO()
+    Image.open(io.BytesIO(ela_image)).save(out, format='WEBP', quality=REPORT_WEBP_QUALITY)
+    return "data:image/webp;base64," + base64.b64encode(out.getvalue()).decode('ascii')
+
+def generate_ela_block(manipulation_check, embed_ela):
+    """Встроенное ELA-изображение (только для упаковки inline/gzip)"""
+    if not embed_ela or 'ela_image' not in manipulation_check:
+        return ""
+    return f"""
+            <div class="mt-4">
+                <h4>Карта ELA:</h4>
+                <img src="{ela_data_uri(manipulation_check['ela_image'])}" class="img-fluid rounded" alt="ELA">
+            </div>
+    """
+
+def generate_manipulation_section(manipulation_check, embed_ela=False):
     """Генерирует секцию анализа редактирования"""
     if not manipulation_check:
         return """
@@ -1038,6 +2745,8 @@ def generate_manipulation_section(manipulation_check):
     # Рассчитываем прогресс (максимальное значение 50 для визуализации)
     progress_width = min(manipulation_check['ela_score'] * 2, 100)
     score = manipulation_check['ela_score']
+    regions_html = generate_regions_block(manipulation_check.get('regions'))
+    ela_html = generate_ela_block(manipulation_check, embed_ela)
     
     # Определяем уровень риска
     if score < 10:
@@ -1069,7 +2778,7 @@ def generate_manipulation_section(manipulation_check):
                     <span class="tag {risk_color}"><i class="fas {risk_icon} me-2"></i>{risk_level}</span>
                 </div>
                 <div class="progress-container mt-3">
-                    <div id="ela-progress" class="progress-bar" data-progress="{progress_width}" style="width: 0%"></div>
+                    <div class="progress-bar" data-progress="{progress_width}" style="width: 0%"></div>
                 </div>
                 <div class="d-flex justify-content-between mt-2">
                     <small>0 (Минимальная)</small>
@@ -1087,11 +2796,99 @@ def generate_manipulation_section(manipulation_check):
                     <div class="tag tag-danger"><i class="fas fa-exclamation-circle me-2"></i>25+: Вероятно редактирование</div>
                 </div>
             </div>
+            {regions_html}
+            {ela_html}
+        </div>
+    </div>
+    """
+
+def generate_regions_block(regions):
+    """Генерирует список подозрительных областей ELA"""
+    if not regions:
+        return ""
+    
+    rows = "".join(
+        f'<tr><td>{i}</td><td>{r["box"][0]}, {r["box"][1]} — {r["box"][2]}, {r["box"][3]}</td>'
+        f'<td>{r["mean"]:.1f}</td><td>{r["max"]:.0f}</td></tr>'
+        for i, r in enumerate(regions, 1)
+    )
+    return f"""
+            <div class="mt-4">
+                <h4>Подозрительные области:</h4>
+                <table class="metadata-table">
+                    <thead>
+                        <tr><th>#</th><th>Область (x1, y1 — x2, y2)</th><th>Средняя интенсивность</th><th>Максимум</th></tr>
+                    </thead>
+                    <tbody>{rows}</tbody>
+                </table>
+            </div>
+    """
+
+def format_coordinates(lat, lon):
+    """Координаты в виде 44.952117° N, 34.102417° E"""
+    lat_str = f"{abs(lat):.6f}° {'N' if lat >= 0 else 'S'}"
+    lon_str = f"{abs(lon):.6f}° {'E' if lon >= 0 else 'W'}"
+    return f"{lat_str}, {lon_str}"
+
+def generate_album_location_section(located):
+    """Секция геолокации альбома: список мест и общая карта со всеми метками"""
+    if not located:
+        return generate_location_section(None, None, None, None, "")
+    
+    items = []
+    markers = []
+    for name, result in located:
+        address = html.escape(result['address']) if result['address'] else 'Адрес не определен'
+        landmark = html.escape(result['landmark']) if result['landmark'] else 'Не определена'
+        markers.append((result['lat'], result['lon'], f"{name}: {address}"))
+        provenance = result.get('provenance')
+        inherited = " · от похожей копии" if provenance and provenance.get('location_inherited') else ""
+        items.append(f"""
+                <div class="info-item">
+                    <div class="info-icon">
+                        <i class="fas fa-map-pin"></i>
+                    </div>
+                    <div class="info-content">
+                        <div class="info-title">{name} · {format_coordinates(result['lat'], result['lon'])}{inherited}</div>
+                        <div class="info-value">{address}</div>
+                        <div class="info-title">Ближайшая достопримечательность: {landmark}</div>
+                    </div>
+                </div>
+        """)
+    
+    return f"""
+    <div class="row fade-in delay-2">
+        <div class="col-lg-5">
+            <div class="location-info">
+                {''.join(items)}
+            </div>
+        </div>
+        
+        <div class="col-lg-7">
+            <div class="map-container">
+                {generate_album_map_html(markers)}
+            </div>
         </div>
     </div>
     """
 
-def generate_location_section(lat, lon, address, landmark, map_html):
+def generate_inherited_location_note(inherited):
+    """Пометка о координатах, взятых у ранее проанализированной копии снимка"""
+    if not inherited:
+        return ""
+    return """
+                <div class="info-item">
+                    <div class="info-icon">
+                        <i class="fas fa-clone"></i>
+                    </div>
+                    <div class="info-content">
+                        <div class="info-title">Источник координат</div>
+                        <div class="info-value">Похожая копия, проанализированная ранее (в этом файле GPS нет)</div>
+                    </div>
+                </div>
+    """
+
+def generate_location_section(lat, lon, address, landmark, map_html, inherited=False):
     """Генерирует секцию геолокации"""
     if not lat or not lon:
         return """
@@ -1106,21 +2903,18 @@ def generate_location_section(lat, lon, address, landmark, map_html):
         </div>
         """
     
-    # Форматируем координаты
-    lat_str = f"{abs(lat):.6f}° {'N' if lat >= 0 else 'S'}"
-    lon_str = f"{abs(lon):.6f}° {'E' if lon >= 0 else 'W'}"
-    
     return f"""
     <div class="row fade-in delay-2">
         <div class="col-lg-5">
             <div class="location-info">
+                {generate_inherited_location_note(inherited)}
                 <div class="info-item">
                     <div class="info-icon">
                         <i class="fas fa-map-pin"></i>
                     </div>
                     <div class="info-content">
                         <div class="info-title">Координаты</div>
-                        <div class="info-value">{lat_str}, {lon_str}</div>
+                        <div class="info-value">{format_coordinates(lat, lon)}</div>
                     </div>
                 </div>
                 
@@ -1165,11 +2959,50 @@ def generate_location_section(lat, lon, address, landmark, map_html):
     </div>
     """
 
+def generate_provenance_section(provenance):
+    """Генерирует секцию «Снимок встречался ранее» для почти-дубликатов"""
+    if not provenance:
+        return ""
+    
+    similarity = (64 - provenance['distance']) / 64 * 100
+    seen_at = datetime.fromtimestamp(provenance['seen_at']).strftime('%d.%m.%Y %H:%M:%S')
+    if provenance['lat'] and provenance['lon']:
+        place = html.escape(provenance['address']) if provenance['address'] else "Адрес не определен"
+        place += f" ({provenance['lat']:.6f}, {provenance['lon']:.6f})"
+    else:
+        place = "Без геоданных"
+    
+    return f"""
+    <h2 class="section-title fade-in delay-3">
+        <i class="fas fa-history"></i> Снимок встречался ранее
+    </h2>
+    
+    <div class="analysis-result fade-in delay-3">
+        <div class="result-icon" style="background: linear-gradient(135deg, #3498db, #2980b9);">
+            <i class="fas fa-clone"></i>
+        </div>
+        <div class="result-content">
+            <h3>Найдена похожая копия</h3>
+            <p>Это изображение почти совпадает с проанализированным ранее (перекодирование или изменение размера)</p>
+            
+            <div class="mt-4">
+                <div class="info-title">Сходство</div>
+                <div class="info-value">{similarity:.1f}%</div>
+            </div>
+            <div class="mt-3">
+                <div class="info-title">Впервые проанализировано</div>
+                <div class="info-value">{seen_at}</div>
+            </div>
+            <div class="mt-3">
+                <div class="info-title">Местоположение копии</div>
+                <div class="info-value">{place}</div>
+            </div>
+        </div>
+    </div>
+    """
+
 # Обработчики бота
-@bot.message_handler(commands=['start', 'help'])
-def send_welcome(message):
-    """Обработчик команд /start и /help"""
-    welcome_text = """
+WELCOME_TEXT = """
 🖼️ *Бот для анализа метаданных фотографий*
 Создатель: @coaox
 Отправьте мне фотографию (как изображение или файл), и я:
@@ -1185,170 +3018,1067 @@ def send_welcome(message):
 /start - показать это сообщение
 /help - помощь по использованию бота
 """
-    bot.reply_to(message, welcome_text, parse_mode='Markdown')
+
+@bot.message_handler(commands=['start', 'help'])
+def send_welcome(message):
+    """Обработчик команд /start и /help"""
+    telegram.reply_to(message, WELCOME_TEXT, parse_mode='Markdown')
 
 @bot.message_handler(content_types=['photo'])
 def handle_photo(message):
     """Обработчик фотографий"""
     try:
-        file_info = bot.get_file(message.photo[-1].file_id)
-        downloaded_file = bot.download_file(file_info.file_path)
-        process_image(message, downloaded_file)
+        photo = message.photo[-1]
+        if message.media_group_id:
+            collect_album_item(message, photo.file_id, photo.file_unique_id)
+        else:
+            process_telegram_file(message, photo.file_id, photo.file_unique_id)
     except Exception as e:
         logger.error(f"Photo error: {e}")
-        bot.reply_to(message, "❌ Ошибка обработки фото. Попробуйте отправить как файл.")
+        telegram.reply_to(message, "❌ Ошибка обработки фото. Попробуйте отправить как файл.")
 
 @bot.message_handler(content_types=['document'])
 def handle_document(message):
     """Обработчик документов"""
     try:
-        if not message.document.file_name:
-            bot.reply_to(message, "❌ Файл без имени не поддерживается.")
+        rejection = document_rejection(message.document)
+        if rejection:
+            telegram.reply_to(message, rejection)
             return
 
-        ext = os.path.splitext(message.document.file_name.lower())[1]
-        if ext not in SUPPORTED_EXTENSIONS:
-            bot.reply_to(message, f"❌ Формат {ext} не поддерживается.")
-            return
+        if message.media_group_id:
+            collect_album_item(message, message.document.file_id, message.document.file_unique_id)
+        else:
+            process_telegram_file(message, message.document.file_id, message.document.file_unique_id)
+    except Exception as e:
+        logger.error(f"Document error: {e}")
+        telegram.reply_to(message, "❌ Ошибка обработки файла. Убедитесь, что это изображение.")
 
-        if message.document.file_size > MAX_FILE_SIZE:
-            bot.reply_to(message, "❌ Файл слишком большой (максимум 20МБ)")
-            return
+def document_rejection(document):
+    """Проверяет документ до загрузки; возвращает текст отказа или None"""
+    if not document.file_name:
+        return "❌ Файл без имени не поддерживается."
+
+    ext = os.path.splitext(document.file_name.lower())[1]
+    if ext not in SUPPORTED_EXTENSIONS:
+        return f"❌ Формат {ext} не поддерживается."
 
-        file_info = bot.get_file(message.document.file_id)
-        downloaded_file = bot.download_file(file_info.file_path)
-        process_image(message, downloaded_file)
+    if document.file_size > MAX_FILE_SIZE:
+        return "❌ Файл слишком большой (максимум 20МБ)"
+    return None
+
+def known_file_digest(file_unique_id):
+    """Хэш содержимого, если результат анализа этого файла уже в кэше"""
+    digest = file_digest_get(file_unique_id)
+    if digest and result_cache_get(digest):
+        logger.info(f"Known file {file_unique_id}, download skipped")
+        return digest
+    return None
+
+def process_telegram_file(message, file_id, file_unique_id):
+    """Скачивает файл и ставит его в очередь; уже проанализированные файлы не скачиваются"""
+    digest = known_file_digest(file_unique_id)
+    if digest:
+        process_image(message, None, file_id=file_id, file_unique_id=file_unique_id, digest=digest)
+        return
+    
+    downloaded_file, rejection = download_image(file_id)
+    if rejection:
+        telegram.reply_to(message, rejection)
+        return
+    process_image(message, downloaded_file, file_id=file_id, file_unique_id=file_unique_id)
+
+def collect_album_item(message, file_id, file_unique_id):
+    """Копит фото альбома и ставит его в очередь одним заданием после паузы"""
+    key = (message.chat.id, message.media_group_id)
+    with album_lock:
+        album = album_buffers.get(key)
+        if album is None:
+            album = album_buffers[key] = {'message': message, 'items': [], 'timer': None}
+        elif message.message_id < album['message'].message_id:
+            album['message'] = message
+        album['items'].append({
+            'file_id': file_id,
+            'file_unique_id': file_unique_id,
+            'message_id': message.message_id
+        })
+        # Таймер перезапускается с каждым фото: альбом отправляется, когда поток фото затих
+        if album['timer']:
+            album['timer'].cancel()
+        album['timer'] = threading.Timer(ALBUM_COLLECT_DELAY, flush_album, args=(key,))
+        album['timer'].daemon = True
+        album['timer'].start()
+
+def flush_album(key):
+    """Ставит собранный альбом в очередь"""
+    with album_lock:
+        album = album_buffers.pop(key, None)
+    if album is None:
+        return
+    
+    items = sorted(album['items'], key=lambda item: item['message_id'])
+    try:
+        process_album(album['message'], items)
     except Exception as e:
-        logger.error(f"Document error: {e}")
-        bot.reply_to(message, "❌ Ошибка обработки файла. Убедитесь, что это изображение.")
+        logger.error(f"Album error: {e}")
+        telegram.reply_to(album['message'], "❌ Ошибка обработки альбома.")
+
+# Потоковая загрузка файлов
+IMAGE_SIGNATURES = (
+    ('jpeg', 0, b"\xff\xd8\xff"),
+    ('png', 0, b"\x89PNG\r\n\x1a\n"),
+    ('tiff', 0, b"II*\x00"),
+    ('tiff', 0, b"MM\x00*"),
+    ('webp', 8, b"WEBP"),
+    ('heic', 4, b"ftyp"),
+)
+HEIC_BRANDS = (b"heic", b"heix", b"hevc", b"hevx", b"mif1", b"msf1")
+SNIFF_SIZE = 16
+
+def sniff_image_format(head):
+    """Определяет формат по сигнатуре в начале файла (None - не поддерживается)"""
+    for name, offset, signature in IMAGE_SIGNATURES:
+        if head[offset:offset + len(signature)] == signature:
+            if name == 'webp' and head[:4] != b"RIFF":
+                continue
+            if name == 'heic' and head[8:12] not in HEIC_BRANDS:
+                continue
+            return name
+    return None
+
+class ImageDownload:
+    """Проверки загружаемого файла по мере поступления блоков (общие для sync и async)"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.buffer = bytearray()
+        self.image_format = None
+        self.prefetched = False
+
+    def check_size(self, size):
+        """Отказ по заявленному размеру (file_size, Content-Length)"""
+        if size and int(size) > self.max_size:
+            return f"❌ Файл слишком большой (максимум {self.max_size // (1024 * 1024)}МБ)"
+        return None
+
+    def feed(self, chunk):
+        """Добавляет блок; возвращает текст отказа, если загрузку пора прервать"""
+        buffer = self.buffer
+        buffer += chunk
+        if len(buffer) > self.max_size:
+            return self.check_size(len(buffer))
+        # Первый блок: сигнатура формата (остальное не скачиваем, если формат чужой)
+        if self.image_format is None and len(buffer) >= SNIFF_SIZE:
+            self.image_format = sniff_image_format(buffer)
+            if self.image_format is None:
+                return "❌ Файл не является поддерживаемым изображением."
+        # JPEG: как только пришли все сегменты до скана, EXIF разбирается параллельно загрузке
+        if self.image_format == 'jpeg' and not self.prefetched:
+            header_end = metadata_region_end(buffer)
+            if header_end < len(buffer):
+                self.prefetched = True
+                stage_pool.submit(prefetch_location, bytes(buffer[:header_end]))
+        return None
 
-def process_image(message, image_bytes):
-    """Обрабатывает изображение в отдельном потоке"""
-    user_id = message.from_user.id
-    chat_id = message.chat.id
+    def finish(self):
+        """Возвращает (байты, текст отказа) после последнего блока"""
+        image_bytes = bytes(self.buffer)
+        image_format = self.image_format or sniff_image_format(image_bytes)
+        if image_format is None or not is_image_intact(image_bytes, image_format):
+            return None, "❌ Файл не является поддерживаемым изображением."
+        return image_bytes, None
+
+def telegram_file_url(file_url, token, file_path):
+    """URL файла на серверах Telegram (с учетом собственного Bot API сервера)"""
+    if file_url is None:
+        return f"https://api.telegram.org/file/bot{token}/{file_path}"
+    return file_url.format(token, file_path)
+
+def download_image(file_id, max_size=MAX_FILE_SIZE):
+    """Скачивает файл потоком с проверкой формата и размера; возвращает (байты, текст отказа)"""
+    file_info = bot.get_file(file_id)
+    download = ImageDownload(max_size)
+    rejection = download.check_size(file_info.file_size)
+    if rejection:
+        return None, rejection
     
-    user_data[user_id] = {
-        'image_bytes': image_bytes,
-        'message': message,
-        'processed': False
-    }
+    url = telegram_file_url(apihelper.FILE_URL, bot.token, file_info.file_path)
+    with download_session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT, proxies=apihelper.proxy) as response:
+        response.raise_for_status()
+        rejection = download.check_size(response.headers.get('Content-Length'))
+        if rejection:
+            return None, rejection
+        for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+            rejection = download.feed(chunk)
+            if rejection:
+                return None, rejection
+    return download.finish()
+
+def is_image_intact(image_bytes, image_format):
+    """Дешевая проверка целостности: заголовок читается без декодирования пикселей"""
+    if image_format == 'jpeg' and metadata_region_end(image_bytes) >= len(image_bytes):
+        return False  # Нет данных скана
+    if image_format == 'heic':
+        return True  # Pillow без плагина не читает HEIC
+    try:
+        Image.open(io.BytesIO(image_bytes))
+        return True
+    except Exception as e:
+        logger.warning(f"Corrupted {image_format} file: {e}")
+        return False
+
+def prefetch_location(header):
+    """Запускает геокодирование по EXIF из заголовка, пока файл еще докачивается"""
+    try:
+        lat, lon = extract_gps(header)
+        if lat and lon:
+            locate(lat, lon)
+    except Exception as e:
+        logger.error(f"Location prefetch error: {e}")
+
+# Планировщик заданий
+def start_workers():
+    """Запускает фиксированный пул воркеров (однократно)"""
+    global cpu_pool
+    with jobs_lock:
+        if workers:
+            return
+        if CPU_WORKERS > 0:
+            # Процесс уже многопоточный: fork унаследовал бы захваченные блокировки,
+            # поэтому дочерние процессы стартуют заново (forkserver, на Windows/macOS - spawn)
+            start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            cpu_pool = ProcessPoolExecutor(max_workers=CPU_WORKERS,
+                                           mp_context=multiprocessing.get_context(start_method))
+        for i in range(WORKER_COUNT):
+            worker = threading.Thread(target=worker_loop, name=f"image-worker-{i}", daemon=True)
+            worker.start()
+            workers.append(worker)
+
+def worker_loop():
+    """Цикл воркера: берет задания из очереди и обрабатывает их"""
+    global busy_workers
+    while True:
+        job = job_queue.get()
+        job.started = time.time()
+        with jobs_lock:
+            busy_workers += 1
+        try:
+            if job.album:
+                process_album_thread(job)
+            else:
+                process_image_thread(job)
+        except Exception as e:
+            logger.error(f"Worker error: {e}")
+        finally:
+            job_store.finish(job.id)
+            with jobs_lock:
+                busy_workers -= 1
+                release_user_slot(job.user_id)
+            job_queue.task_done()
+            logger.info(
+                f"Job {job.id} done: waited {job.started - job.created:.2f}s, "
+                f"ran {time.time() - job.started:.2f}s; store: {job_store.stats()}"
+            )
+
+def reserve_user_slot(user_id):
+    """Резервирует место в очереди; возвращает текст отказа или None"""
+    if user_jobs.get(user_id, 0) >= MAX_JOBS_PER_USER:
+        return "⏳ Дождитесь завершения анализа предыдущего изображения."
+    if job_queue.full():
+        return "❌ Сервер перегружен, попробуйте отправить изображение позже."
+    user_jobs[user_id] = user_jobs.get(user_id, 0) + 1
+    return None
+
+def release_user_slot(user_id):
+    """Освобождает место пользователя (вызывается под jobs_lock)"""
+    if user_jobs.get(user_id, 0) <= 1:
+        user_jobs.pop(user_id, None)
+    else:
+        user_jobs[user_id] -= 1
+
+def run_cpu_task(func, *args):
+    """Выполняет CPU-этап в пуле процессов (если включен), иначе в текущем потоке"""
+    if cpu_pool is None:
+        return func(*args)
+    return cpu_pool.submit(func, *args).result()
+
+def process_image(message, image_bytes, file_id=None, file_unique_id=None, digest=None):
+    """Ставит изображение в очередь на обработку (без байтов, если результат уже известен по digest)"""
+    enqueue_job(Job(message, image_bytes, file_id=file_id, file_unique_id=file_unique_id, digest=digest))
+
+def process_album(message, items):
+    """Ставит альбом в очередь одним заданием: одно статусное сообщение, один отчет"""
+    enqueue_job(Job(message, album=items))
+
+def enqueue_job(job):
+    """Резервирует место пользователя, создает статусное сообщение и ставит задание в очередь"""
+    message = job.message
     
-    if not create_status_message(user_id, chat_id):
-        bot.reply_to(message, "❌ Не удалось начать анализ изображения")
+    start_workers()
+    with jobs_lock:
+        rejection = reserve_user_slot(job.user_id)
+    if rejection:
+        telegram.reply_to(message, rejection)
         return
     
-    thread = threading.Thread(target=process_image_thread, args=(user_id,))
-    thread.start()
+    job_store.add(job)
+    
+    if not create_status_message(job):
+        job_store.finish(job.id)
+        with jobs_lock:
+            release_user_slot(job.user_id)
+        telegram.reply_to(message, "❌ Не удалось начать анализ изображения")
+        return
+    
+    with jobs_lock:
+        # Позиция среди заданий, которым не хватило свободного воркера
+        ahead = busy_workers + job_queue.qsize() - WORKER_COUNT
+        position = ahead + 1 if ahead >= 0 else 0
+        try:
+            job_queue.put_nowait(job)
+        except queue.Full:
+            release_user_slot(job.user_id)
+            position = None
+    
+    if position is None:
+        job_store.finish(job.id)
+        telegram.reply_to(message, "❌ Сервер перегружен, попробуйте отправить изображение позже.")
+    elif position:
+        telegram.reply_to(message, f"⏳ Вы {position}-й в очереди. Анализ начнется автоматически.")
 
-def process_image_thread(user_id):
+def process_image_thread(job):
     """Поток обработки изображения"""
     try:
-        data = user_data[user_id]
-        message = data['message']
-        image_bytes = data['image_bytes']
-        
-        # 1. Извлечение метаданных (используем улучшенную функцию)
-        update_status_step(user_id, "metadata", "progress", "Извлечение данных...")
-        metadata, lat, lon, extracted_count = extract_metadata_advanced(image_bytes)
-        update_status_step(user_id, "metadata", "completed", f"Найдено {extracted_count} параметров")
-        time.sleep(1)
-
-        # 2. Поиск геолокации
-        update_status_step(user_id, "geolocation", "progress", "Поиск координат...")
-        address, landmark = None, None
+        message = job.message
+        step = functools.partial(update_status_step, job)
         
-        if lat and lon:
-            try:
-                update_status_step(user_id, "geolocation", "progress", "Определение местоположения...")
-                location = get_location_info(lat, lon)
-                address = location['address'] if location else None
-                landmark = get_landmark(lat, lon)
-                update_status_step(user_id, "geolocation", "completed", "Координаты найдены")
-            except Exception as e:
-                logger.error(f"Geocoding error: {e}")
-                update_status_step(user_id, "geolocation", "completed", "Ошибка геокодирования")
+        # Повторная загрузка того же файла: отдаем сохраненный результат без анализа
+        image_bytes, digest, result = load_cached_result(job.file_id, job.file_unique_id, job.digest, job.image_bytes)
+        if result:
+            complete_status_steps(step, result)
         else:
-            update_status_step(user_id, "geolocation", "completed", "GPS данные отсутствуют")
-        time.sleep(1)
+            result = run_analysis(step, image_bytes, digest)
 
-        # 3. Анализ местоположения
-        update_status_step(user_id, "location_analysis", "progress", "Обработка...")
-        if lat and lon:
-            update_status_step(user_id, "location_analysis", "completed", "Данные получены")
-        else:
-            update_status_step(user_id, "location_analysis", "completed", "Требуются координаты")
-        time.sleep(0.5)
-
-        # 4. Проверка на редактирование
-        update_status_step(user_id, "manipulation_check", "progress", "Анализ ELA...")
-        manipulation_check = check_image_manipulation(image_bytes)
-        if manipulation_check:
-            status = "Возможно редактировано" if manipulation_check['is_edited'] else "Оригинальное"
-            update_status_step(user_id, "manipulation_check", "completed", status)
-        else:
-            update_status_step(user_id, "manipulation_check", "completed", "Анализ не выполнен")
-        time.sleep(0.5)
+        # Исходное изображение больше не нужно
+        job_store.update(job.id, {'image_bytes': None, 'digest': digest})
 
-        # Сохраняем данные
-        user_data[user_id].update({
-            'processed': True,
-            'metadata': metadata,
+        # Финальное сообщение
+        try:
+            finish_status_message(job)
+            
+            # Генерируем HTML отчет (из кэша - уже готовый, если собран с той же упаковкой ELA)
+            if 'report' not in result or result.get('report_embeds_ela', False) != REPORT_EMBED_ELA:
+                result['report'] = render_html_report(
+                    metadata=result['metadata'],
+                    lat=result['lat'],
+                    lon=result['lon'],
+                    address=result['address'],
+                    landmark=result['landmark'],
+                    manipulation_check=result['manipulation_check'],
+                    provenance=result.get('provenance'),
+                    embed_ela=REPORT_EMBED_ELA,
+                    generated_at=REPORT_TIMESTAMP
+                ).getvalue()
+                result['report_embeds_ela'] = REPORT_EMBED_ELA
+                if not result['geocoding_failed']:
+                    result_cache_put(digest, result)
+            job_store.update(job.id, {'result': job_result_entry(digest, result)})
+            send_results(message, result, job.status.message_id)
+
+        except Exception as e:
+            logger.error(f"Final processing error: {e}")
+            telegram.send_message(message.chat.id, "⚠️ Произошла ошибка при формировании отчета.")
+
+    except Exception as e:
+        logger.error(f"Processing thread error: {e}")
+        telegram.send_message(job.chat_id, "⚠️ Произошла критическая ошибка при анализе изображения")
+
+def job_result_entry(digest, result):
+    """Результат для хранилища заданий: закэшированный хранится по ссылке (хэшу), а не второй копией"""
+    if digest and 'rejection' not in result and not result['geocoding_failed']:
+        return {'digest': digest}
+    return result
+
+def load_cached_result(file_id, file_unique_id, digest, image_bytes):
+    """Возвращает (байты, хэш, результат из кэша или None)"""
+    digest = digest or content_digest(image_bytes)
+    result = result_cache_get(digest)
+    if result is None and image_bytes is None:
+        # Результат вытеснен из кэша после проверки file_unique_id - скачиваем файл
+        image_bytes, rejection = download_image(file_id)
+        if rejection:
+            raise ValueError(rejection)
+        digest = content_digest(image_bytes)
+        result = result_cache_get(digest)
+    if file_unique_id:
+        file_digest_put(file_unique_id, digest)
+    if result:
+        logger.info(f"Result cache hit: {digest}")
+        # Копия: закэшированный словарь общий для всех заданий с тем же файлом
+        result = dict(result)
+    return image_bytes, digest, result
+
+def run_analysis(step, image_bytes, digest):
+    """Выполняет этапы анализа; step(этап, статус, текст) отмечает их завершение"""
+    # EXIF разбирается один раз: координаты сразу запускают геокодирование, остальное - в метаданные
+    try:
+        exif = parse_exif(image_bytes)
+    except Exception as e:
+        logger.error(f"EXIF parse error: {e}")
+        exif = {}
+    lat, lon = extract_gps_from_ifd(exif)
+    step("metadata", "progress", "Извлечение данных...")
+    step("manipulation_check", "progress", "Анализ ELA...")
+    
+    # Перекодированная или уменьшенная копия уже проанализированного снимка
+    phash, match = None, None
+    try:
+        phash = perceptual_hash(image_bytes)
+        match = phash_index.find(phash)
+    except Exception as e:
+        logger.error(f"Perceptual hash error: {e}")
+    # Пересжатые и пересланные копии обычно теряют EXIF GPS - берем место у найденного оригинала
+    inherited = match[1] if match and not (lat and lon) and match[1]['lat'] and match[1]['lon'] else None
+    
+    geocoding_future = None
+    if lat and lon:
+        step("geolocation", "progress", "Определение местоположения...")
+        geocoding_future = stage_pool.submit(locate, lat, lon)
+    elif inherited:
+        step("geolocation", "completed", "Координаты взяты у похожей копии")
+    else:
+        step("geolocation", "completed", "GPS данные отсутствуют")
+    manipulation_future = stage_pool.submit(run_cpu_task, check_image_manipulation, image_bytes)
+    
+    # 1. Извлечение метаданных
+    metadata, lat, lon, extracted_count = run_cpu_task(extract_metadata_advanced, image_bytes, exif)
+    step("metadata", "completed", f"Найдено {extracted_count} параметров")
+
+    # 2. Поиск геолокации
+    address, landmark = None, None
+    if inherited and not (lat and lon):
+        lat, lon = inherited['lat'], inherited['lon']
+        address = inherited['address'] or "Местоположение не определено"
+        landmark = inherited['landmark'] or "Достопримечательность не найдена"
+    else:
+        inherited = None
+    geocoding_failed = False
+    if geocoding_future:
+        try:
+            location = geocoding_future.result()
+            geocoding_failed = location is None
+            address = location['address'] if location else "Местоположение не определено"
+            landmark = location['landmark'] if location and location['landmark'] else "Достопримечательность не найдена"
+            step("geolocation", "completed", "Координаты найдены")
+        except Exception as e:
+            logger.error(f"Geocoding error: {e}")
+            geocoding_failed = True
+            step("geolocation", "completed", "Ошибка геокодирования")
+
+    # 3. Анализ местоположения
+    if lat and lon:
+        step("location_analysis", "completed", "Данные получены")
+    else:
+        step("location_analysis", "completed", "Требуются координаты")
+
+    # 4. Проверка на редактирование
+    manipulation_check = manipulation_future.result()
+    if manipulation_check:
+        status = "Возможно редактировано" if manipulation_check['is_edited'] else "Оригинальное"
+        step("manipulation_check", "completed", status)
+    else:
+        step("manipulation_check", "completed", "Анализ не выполнен")
+    
+    provenance = dict(match[1], distance=match[0], location_inherited=bool(inherited)) if match else None
+    if phash is not None:
+        phash_index.add(phash, {
+            'digest': digest,
+            'seen_at': time.time(),
             'lat': lat,
             'lon': lon,
-            'address': address,
-            'landmark': landmark,
-            'manipulation_check': manipulation_check
+            'address': None if geocoding_failed else address,
+            'landmark': None if geocoding_failed else landmark
         })
+    
+    return {
+        'metadata': metadata,
+        'extracted_count': extracted_count,
+        'lat': lat,
+        'lon': lon,
+        'address': address,
+        'landmark': landmark,
+        'geocoding_failed': geocoding_failed,
+        'manipulation_check': manipulation_check,
+        'provenance': provenance
+    }
+
+def complete_status_steps(step, result):
+    """Отмечает все этапы завершенными по сохраненному результату"""
+    has_gps = result['lat'] and result['lon']
+    step("metadata", "completed", f"Найдено {result['extracted_count']} параметров")
+    step("geolocation", "completed", "Координаты найдены" if has_gps else "GPS данные отсутствуют")
+    step("location_analysis", "completed", "Данные получены" if has_gps else "Требуются координаты")
+    manipulation_check = result['manipulation_check']
+    if manipulation_check:
+        status = "Возможно редактировано" if manipulation_check['is_edited'] else "Оригинальное"
+        step("manipulation_check", "completed", status)
+    else:
+        step("manipulation_check", "completed", "Анализ не выполнен")
+
+def send_results(message, result, status_message_id):
+    """Отправляет ELA-изображение и HTML отчет, затем удаляет статусное сообщение"""
+    manipulation_check = result['manipulation_check']
+    ela_images = [("ELA", manipulation_check['ela_image'])] \
+        if manipulation_check and 'ela_image' in manipulation_check else []
+    send_packaged_results(
+        message.chat.id,
+        f"image_report_{datetime.now().strftime('%d%m%Y_%H%M%S')}",
+        stamp_report(result['report']),
+        ela_images,
+        "📊 Вот ваш детализированный отчет об анализе изображения"
+    )
+    
+    # Удаляем статусное сообщение
+    try:
+        telegram.delete_message(message.chat.id, status_message_id)
+    except Exception as e:
+        logger.error(f"Error deleting status message: {e}")
+
+# Обработка альбомов
+class AlbumProgress:
+    """Сводный прогресс этапов по всем фото альбома для статусного сообщения"""
+    STEPS = ("metadata", "geolocation", "location_analysis", "manipulation_check")
+
+    def __init__(self, job, total):
+        self.job = job
+        self.total = total
+        self.done = dict.fromkeys(self.STEPS, 0)
+        self.lock = threading.Lock()
+
+    def step(self, step_name, status="progress", message=""):
+        """Совместим с update_status_step: текст этапа заменяется счетчиком фото"""
+        with self.lock:
+            if status == "completed":
+                self.done[step_name] += 1
+            self._report(step_name)
+
+    def skip(self):
+        """Фото не удалось разобрать: его этапы считаются завершенными"""
+        with self.lock:
+            for step_name in self.STEPS:
+                self.done[step_name] += 1
+                self._report(step_name)
+
+    def _report(self, step_name):
+        # Под self.lock: иначе поздний поток может откатить счетчик назад
+        done = self.done[step_name]
+        status = "completed" if done >= self.total else "progress"
+        update_status_step(self.job, step_name, status, f"{done}/{self.total} фото")
+
+def process_album_thread(job):
+    """Поток обработки альбома: фото анализируются параллельно, отчет общий"""
+    try:
+        message = job.message
+        
+        # Одинаковые координаты внутри альбома геокодируются один раз (кэш + single-flight)
+        progress = AlbumProgress(job, len(job.album))
+        analysed = list(album_pool.map(lambda item: analyze_album_item(progress, item), job.album))
+        results = [result for _, result in analysed]
+        job_store.update(job.id, {'result': {'album': [job_result_entry(digest, result) for digest, result in analysed]}})
 
-        # Финальное сообщение
         try:
-            status_data = user_data[user_id]['status_message']
-            final_text = status_data['status'].replace("🔍 *Анализ изображения начат...*", "✅ *Анализ успешно завершен!*")
-            update_status_message(user_id, final_text)
+            finish_status_message(job)
             
-            # Генерируем HTML отчет
-            html_content = generate_html_report(
-                metadata=metadata,
-                lat=lat,
-                lon=lon,
-                address=address,
-                landmark=landmark,
-                manipulation_check=manipulation_check
+            report = render_album_report(results, REPORT_EMBED_ELA).getvalue()
+            send_album_results(message, results, report, job.status.message_id)
+
+        except Exception as e:
+            logger.error(f"Final album processing error: {e}")
+            telegram.send_message(message.chat.id, "⚠️ Произошла ошибка при формировании отчета.")
+
+    except Exception as e:
+        logger.error(f"Album thread error: {e}")
+        telegram.send_message(job.chat_id, "⚠️ Произошла критическая ошибка при анализе альбома")
+
+def analyze_album_item(progress, item):
+    """Анализирует одно фото альбома: (хэш, результат); ошибка одного фото не прерывает весь альбом"""
+    try:
+        image_bytes = None
+        digest = known_file_digest(item['file_unique_id'])
+        if not digest:
+            image_bytes, rejection = download_image(item['file_id'])
+            if rejection:
+                progress.skip()
+                return None, {'rejection': rejection}
+        
+        image_bytes, digest, result = load_cached_result(item['file_id'], item['file_unique_id'], digest, image_bytes)
+        if result:
+            complete_status_steps(progress.step, result)
+        else:
+            result = run_analysis(progress.step, image_bytes, digest)
+            if not result['geocoding_failed']:
+                result_cache_put(digest, result)
+        return digest, result
+    except Exception as e:
+        logger.error(f"Album item error: {e}")
+        progress.skip()
+        return None, {'rejection': "⚠️ Ошибка анализа изображения"}
+
+def send_album_results(message, results, report, status_message_id):
+    """Отправляет ELA-изображения одной медиагруппой и общий HTML отчет"""
+    ela_images = [
+        (f"Фото {index}", result['manipulation_check']['ela_image'])
+        for index, result in enumerate(results, 1)
+        if result.get('manipulation_check') and 'ela_image' in result['manipulation_check']
+    ]
+    caption = f"📊 Общий отчет по альбому ({len(results)} фото)"
+    skipped = [f"Фото {index}" for index, result in enumerate(results, 1) if 'rejection' in result]
+    if skipped:
+        caption += f"\nНе проанализированы: {', '.join(skipped)}"
+    send_packaged_results(
+        message.chat.id,
+        f"album_report_{datetime.now().strftime('%d%m%Y_%H%M%S')}",
+        report,
+        ela_images,
+        caption
+    )
+    
+    try:
+        telegram.delete_message(message.chat.id, status_message_id)
+    except Exception as e:
+        logger.error(f"Error deleting status message: {e}")
+
+# Упаковка результатов
+MEDIA_GROUP_LIMIT = 10  # Максимум файлов в одной медиагруппе Telegram
+
+def named_stream(data, name):
+    """BytesIO с именем файла для загрузки в Telegram"""
+    stream = io.BytesIO(data)
+    stream.name = name
+    return stream
+
+def ela_file_name(index, count):
+    return "ela.jpg" if count == 1 else f"ela_{index}.jpg"
+
+def ela_caption(label, count):
+    return "🔍 Результат анализа на редактирование (ELA)" if count == 1 else f"🔍 ELA: {label}"
+
+def package_zip(name, report, ela_images):
+    """ZIP: отчет сжимается, JPEG кладется без сжатия (он уже сжат)"""
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, 'w') as archive:
+        archive.writestr(f"{name}.html", report, compress_type=zipfile.ZIP_DEFLATED)
+        for index, (_, image) in enumerate(ela_images, 1):
+            archive.writestr(ela_file_name(index, len(ela_images)), image, compress_type=zipfile.ZIP_STORED)
+    return out.getvalue()
+
+def send_packaged_results(chat_id, name, report, ela_images, caption):
+    """Отправляет ELA-изображения [(подпись, JPEG)] и отчет в формате REPORT_PACKAGING"""
+    if REPORT_PACKAGING == "zip":
+        telegram.send_document(chat_id, named_stream(package_zip(name, report, ela_images), f"{name}.zip"), caption=caption)
+    elif REPORT_PACKAGING == "gzip":
+        # ELA уже встроен в отчет; mtime=0 - одинаковый отчет дает одинаковый архив
+        data = gzip.compress(report, compresslevel=REPORT_GZIP_LEVEL, mtime=0)
+        telegram.send_document(chat_id, named_stream(data, f"{name}.html.gz"), caption=caption)
+    elif REPORT_PACKAGING == "inline":
+        telegram.send_document(chat_id, named_stream(report, f"{name}.html"), caption=caption)
+    elif REPORT_PACKAGING == "media_group":
+        # Telegram не смешивает фото и документы в одной группе: ELA отправляется файлом
+        documents = [
+            telebot.types.InputMediaDocument(
+                named_stream(image, ela_file_name(index, len(ela_images))), caption=ela_caption(label, len(ela_images))
             )
-            
-            # Создаем файл отчета
-            file_stream = io.BytesIO(html_content.encode('utf-8'))
-            file_stream.name = f"image_report_{datetime.now().strftime('%d%m%Y_%H%M%S')}.html"
-            
-            # Отправляем ELA анализ если есть
-            if manipulation_check and 'ela_image' in manipulation_check:
-                bot.send_photo(
-                    message.chat.id, 
-                    manipulation_check['ela_image'], 
-                    caption="🔍 Результат анализа на редактирование (ELA)"
-                )
-            
-            # Отправляем HTML отчет
-            bot.send_document(
-                message.chat.id,
-                file_stream,
-                caption="📊 Вот ваш детализированный отчет об анализе изображения"
+            for index, (label, image) in enumerate(ela_images, 1)
+        ]
+        documents.append(telebot.types.InputMediaDocument(named_stream(report, f"{name}.html"), caption=caption))
+        for start in range(0, len(documents), MEDIA_GROUP_LIMIT):
+            group = documents[start:start + MEDIA_GROUP_LIMIT]
+            if len(group) == 1:
+                telegram.send_document(chat_id, group[0].media, caption=group[0].caption)
+            else:
+                telegram.send_media_group(chat_id, group)
+    else:
+        if len(ela_images) > 1:
+            telegram.send_media_group(chat_id, [
+                telebot.types.InputMediaPhoto(image, caption=ela_caption(label, len(ela_images)))
+                for label, image in ela_images
+            ])
+        elif ela_images:
+            telegram.send_photo(chat_id, ela_images[0][1], caption=ela_caption(ela_images[0][0], 1))
+        telegram.send_document(chat_id, named_stream(report, f"{name}.html"), caption=caption)
+
+# Кэш результатов по содержимому файла
+def content_digest(image_bytes):
+    """Хэш содержимого файла (BLAKE2b - быстрее SHA-256 при той же стойкости)"""
+    return hashlib.blake2b(image_bytes, digest_size=20).hexdigest()
+
+def get_result_db():
+    """Возвращает соединение с SQLite-кэшем результатов для текущего потока"""
+    if not RESULT_CACHE_PATH:
+        return None
+    conn = getattr(result_db_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(RESULT_CACHE_PATH, timeout=5, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        # Результаты хранятся в JSON, бинарные поля - отдельными BLOB (без pickle: файл не исполняется)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS analysis_results ("
+            "key TEXT PRIMARY KEY, version INTEGER NOT NULL, value TEXT NOT NULL, "
+            "ela_image BLOB, report BLOB, size INTEGER NOT NULL, accessed REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS analysis_results_accessed ON analysis_results (accessed)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS file_index (unique_id TEXT PRIMARY KEY, digest TEXT NOT NULL)"
+        )
+        result_db_local.conn = conn
+    return conn
+
+def result_cache_get(digest):
+    """Ищет результат анализа в памяти, затем в SQLite"""
+    with cache_lock:
+        if digest in result_cache:
+            return result_cache[digest]
+    
+    try:
+        conn = get_result_db()
+        if conn is None:
+            return None
+        row = conn.execute(
+            "SELECT value, ela_image, report FROM analysis_results WHERE key = ? AND version = ?",
+            (digest, RESULT_CACHE_VERSION)
+        ).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE analysis_results SET accessed = ? WHERE key = ?", (time.time(), digest))
+        result = decode_result(*row)
+        remember_result(digest, result)
+        return result
+    except Exception as e:
+        logger.error(f"Result cache read error: {e}")
+        return None
+
+def result_cache_put(digest, result):
+    """Сохраняет результат анализа в памяти и в SQLite"""
+    global result_db_writes
+    remember_result(digest, result)
+    with cache_lock:
+        result_db_writes += 1
+        evict = result_db_writes % RESULT_CACHE_EVICT_EVERY == 0
+    
+    try:
+        conn = get_result_db()
+        if conn is None:
+            return
+        value, ela_image, report = encode_result(result)
+        size = len(value.encode('utf-8')) + len(ela_image or b"") + len(report or b"")
+        conn.execute(
+            "INSERT OR REPLACE INTO analysis_results (key, version, value, ela_image, report, size, accessed) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (digest, RESULT_CACHE_VERSION, value, ela_image, report, size, time.time())
+        )
+        if evict:
+            evict_result_cache(conn)
+    except Exception as e:
+        logger.error(f"Result cache write error: {e}")
+
+def encode_result(result):
+    """Разделяет результат на JSON и бинарные поля: (JSON, ELA-изображение, отчет)"""
+    data = dict(result)
+    report = data.pop('report', None)
+    ela_image = None
+    if data.get('manipulation_check'):
+        data['manipulation_check'] = dict(data['manipulation_check'])
+        ela_image = data['manipulation_check'].pop('ela_image', None)
+    return json.dumps(data, ensure_ascii=False, default=json_default), ela_image, report
+
+def decode_result(value, ela_image, report):
+    """Собирает результат из JSON и бинарных полей"""
+    result = json.loads(value, object_hook=json_object_hook)
+    if ela_image is not None:
+        result['manipulation_check']['ela_image'] = ela_image
+    if report is not None:
+        result['report'] = report
+    return result
+
+def json_default(value):
+    # Массивы и числа numpy из анализа ELA; прочие типы - ошибка, а не молчаливая порча данных
+    if isinstance(value, np.ndarray):
+        return {'__ndarray__': value.tolist(), 'dtype': str(value.dtype)}
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+def json_object_hook(value):
+    if '__ndarray__' in value:
+        return np.asarray(value['__ndarray__'], dtype=value['dtype'])
+    return value
+
+def file_digest_get(file_unique_id):
+    """Хэш содержимого по file_unique_id Telegram (файл можно не скачивать)"""
+    with cache_lock:
+        digest = file_index.get(file_unique_id)
+    if digest:
+        return digest
+    
+    try:
+        conn = get_result_db()
+        if conn is None:
+            return None
+        row = conn.execute("SELECT digest FROM file_index WHERE unique_id = ?", (file_unique_id,)).fetchone()
+        if row is None:
+            return None
+        with cache_lock:
+            file_index[file_unique_id] = row[0]
+        return row[0]
+    except Exception as e:
+        logger.error(f"File index read error: {e}")
+        return None
+
+def file_digest_put(file_unique_id, digest):
+    """Запоминает соответствие file_unique_id и хэша содержимого"""
+    with cache_lock:
+        if file_index.get(file_unique_id) == digest:
+            return
+        file_index[file_unique_id] = digest
+    
+    try:
+        conn = get_result_db()
+        if conn is not None:
+            conn.execute(
+                "INSERT OR REPLACE INTO file_index (unique_id, digest) VALUES (?, ?)",
+                (file_unique_id, digest)
             )
-            
-            # Удаляем статусное сообщение
-            try:
-                bot.delete_message(message.chat.id, status_data['message_id'])
-            except Exception as e:
-                logger.error(f"Error deleting status message: {e}")
+    except Exception as e:
+        logger.error(f"File index write error: {e}")
+
+def remember_result(digest, result):
+    """Кладет результат в память (LRU с ограничением по объему)"""
+    with cache_lock:
+        try:
+            result_cache[digest] = result
+        except ValueError:
+            # Результат больше всего бюджета памяти - храним только на диске
+            pass
+
+def evict_result_cache(conn):
+    """Удаляет самые давно использованные результаты сверх лимита объема на диске"""
+    conn.execute("DELETE FROM analysis_results WHERE version != ?", (RESULT_CACHE_VERSION,))
+    total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM analysis_results").fetchone()[0]
+    if total <= RESULT_CACHE_DISK:
+        return
+    excess = total - RESULT_CACHE_DISK
+    removed = 0
+    for key, size in conn.execute("SELECT key, size FROM analysis_results ORDER BY accessed").fetchall():
+        if removed >= excess:
+            break
+        conn.execute("DELETE FROM analysis_results WHERE key = ?", (key,))
+        removed += size
+    conn.execute("DELETE FROM file_index WHERE digest NOT IN (SELECT key FROM analysis_results)")
+
+# Прием обновлений через вебхук
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Принимает обновления Telegram: проверяет секрет, сразу отвечает и ставит в очередь"""
+    server_version = "ImageAnalyzerBot"
+
+    def do_POST(self):
+        if self.path != WEBHOOK_PATH:
+            self.respond(404)
+            return
+        secret = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(secret.encode('utf-8'), WEBHOOK_SECRET.encode('utf-8')):
+            self.respond(403)
+            return
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            self.respond(400)
+            return
+        if not 0 < length <= WEBHOOK_MAX_BODY:
+            self.respond(413 if length else 400)
+            return
+        
+        body = self.rfile.read(length)
+        try:
+            update_queue.put_nowait(body)
+        except queue.Full:
+            # Telegram повторит доставку позже
+            self.respond(503)
+            return
+        self.respond(200)
+
+    def do_GET(self):
+        # Проверка живости для балансировщика
+        self.respond(200 if self.path == "/healthz" else 404)
+
+    def respond(self, status):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug(f"Webhook {self.address_string()}: {format % args}")
 
+def start_webhook_server():
+    """Запускает HTTP-сервер вебхука в фоновом потоке"""
+    if not WEBHOOK_SECRET:
+        raise SystemExit("BOT_UPDATES=webhook требует WEBHOOK_SECRET")
+    server = ThreadingHTTPServer((WEBHOOK_LISTEN, WEBHOOK_PORT), WebhookHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="webhook-server", daemon=True).start()
+    logger.info(f"Webhook server listening on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    return server
+
+def decode_update(body):
+    """Разбирает тело запроса вебхука в объект Update"""
+    return telebot.types.Update.de_json(body.decode('utf-8'))
+
+def run_webhook():
+    """Синхронный режим: обновления из очереди раздаются пулу потоков TeleBot"""
+    start_webhook_server()
+    if WEBHOOK_URL:
+        bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+    while True:
+        body = update_queue.get()
+        try:
+            bot.process_new_updates([decode_update(body)])
         except Exception as e:
-            logger.error(f"Final processing error: {e}")
-            bot.send_message(message.chat.id, "⚠️ Произошла ошибка при формировании отчета.")
+            logger.error(f"Webhook update error: {e}")
 
-    except Exception as e:
-        logger.error(f"Processing thread error: {e}")
-        bot.send_message(user_data[user_id]['message'].chat.id, "⚠️ Произошла критическая ошибка при анализе изображения")
+async def run_webhook_async(async_bot):
+    """Асинхронный режим: каждое обновление обрабатывается отдельной задачей"""
+    start_webhook_server()
+    if WEBHOOK_URL:
+        await async_bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+    loop = asyncio.get_running_loop()
+    tasks = set()
+    while True:
+        try:
+            # Ожидание с таймаутом, чтобы поток исполнителя не держал завершение цикла
+            body = await loop.run_in_executor(None, functools.partial(update_queue.get, timeout=1))
+        except queue.Empty:
+            continue
+        try:
+            task = asyncio.create_task(async_bot.process_new_updates([decode_update(body)]))
+        except Exception as e:
+            logger.error(f"Webhook update error: {e}")
+            continue
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+# Асинхронный режим
+class AsyncBotBridge:
+    """Синхронный интерфейс к AsyncTeleBot для кода в потоках воркеров"""
+
+    def __init__(self, async_bot, loop):
+        self.async_bot = async_bot
+        self.loop = loop
+
+    def __getattr__(self, name):
+        attribute = getattr(self.async_bot, name)
+        if not asyncio.iscoroutinefunction(attribute):
+            return attribute
+        
+        def call(*args, **kwargs):
+            # Запрос выполняется в цикле событий; ждет только вызвавший поток
+            return asyncio.run_coroutine_threadsafe(attribute(*args, **kwargs), self.loop).result()
+        return call
+
+async def reply_async(message, text, **kwargs):
+    """Ответ из асинхронного обработчика через общий шлюз исходящих запросов"""
+    return await asyncio.wrap_future(telegram.submit('reply_to', message, text, **kwargs))
+
+async def download_image_async(async_bot, file_id, max_size=MAX_FILE_SIZE):
+    """Неблокирующая потоковая загрузка; возвращает (байты, текст отказа)"""
+    file_info = await async_bot.get_file(file_id)
+    download = ImageDownload(max_size)
+    rejection = download.check_size(file_info.file_size)
+    if rejection:
+        return None, rejection
+    
+    url = telegram_file_url(asyncio_helper.FILE_URL, async_bot.token, file_info.file_path)
+    session = await asyncio_helper.session_manager.get_session()
+    timeout = aiohttp.ClientTimeout(total=DOWNLOAD_TIMEOUT)
+    async with session.get(url, proxy=asyncio_helper.proxy, timeout=timeout) as response:
+        response.raise_for_status()
+        rejection = download.check_size(response.headers.get('Content-Length'))
+        if rejection:
+            return None, rejection
+        async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+            rejection = download.feed(chunk)
+            if rejection:
+                return None, rejection
+    return download.finish()
+
+async def process_telegram_file_async(async_bot, message, file_id, file_unique_id):
+    """Асинхронный аналог process_telegram_file"""
+    loop = asyncio.get_running_loop()
+    # SQLite-кэш и постановка в очередь (статусное сообщение) выполняются вне цикла событий
+    digest = await loop.run_in_executor(None, known_file_digest, file_unique_id)
+    if digest:
+        image_bytes = None
+    else:
+        image_bytes, rejection = await download_image_async(async_bot, file_id)
+        if rejection:
+            await reply_async(message, rejection)
+            return
+    await loop.run_in_executor(None, functools.partial(
+        process_image, message, image_bytes, file_id=file_id, file_unique_id=file_unique_id, digest=digest
+    ))
+
+def register_async_handlers(async_bot):
+    """Обработчики для AsyncTeleBot (повторяют синхронные)"""
+    @async_bot.message_handler(commands=['start', 'help'])
+    async def send_welcome_async(message):
+        await reply_async(message, WELCOME_TEXT, parse_mode='Markdown')
+
+    @async_bot.message_handler(content_types=['photo'])
+    async def handle_photo_async(message):
+        try:
+            photo = message.photo[-1]
+            if message.media_group_id:
+                collect_album_item(message, photo.file_id, photo.file_unique_id)
+            else:
+                await process_telegram_file_async(async_bot, message, photo.file_id, photo.file_unique_id)
+        except Exception as e:
+            logger.error(f"Photo error: {e}")
+            await reply_async(message, "❌ Ошибка обработки фото. Попробуйте отправить как файл.")
+
+    @async_bot.message_handler(content_types=['document'])
+    async def handle_document_async(message):
+        try:
+            rejection = document_rejection(message.document)
+            if rejection:
+                await reply_async(message, rejection)
+                return
+            if message.media_group_id:
+                collect_album_item(message, message.document.file_id, message.document.file_unique_id)
+            else:
+                await process_telegram_file_async(async_bot, message, message.document.file_id, message.document.file_unique_id)
+        except Exception as e:
+            logger.error(f"Document error: {e}")
+            await reply_async(message, "❌ Ошибка обработки файла. Убедитесь, что это изображение.")
+
+async def run_async_bot():
+    """Запускает бота на AsyncTeleBot; воркеры обращаются к Telegram через мост"""
+    global bot
+    async_bot = AsyncTeleBot(TOKEN)
+    bot = AsyncBotBridge(async_bot, asyncio.get_running_loop())
+    register_async_handlers(async_bot)
+    if BOT_UPDATES == "webhook":
+        await run_webhook_async(async_bot)
+    else:
+        await async_bot.infinity_polling()
 
 if __name__ == '__main__':
+    if REPORT_PACKAGING not in REPORT_PACKAGING_MODES:
+        raise SystemExit(f"REPORT_PACKAGING={REPORT_PACKAGING!r}: допустимо {', '.join(REPORT_PACKAGING_MODES)}")
     logger.info("Бот запущен и готов к работе")
-    bot.infinity_polling()
\ No newline at end of file
+    if BOT_RUNTIME == "async":
+        if AsyncTeleBot is None:
+            raise SystemExit("BOT_RUNTIME=async требует aiohttp (pip install aiohttp)")
+        asyncio.run(run_async_bot())
+    elif BOT_UPDATES == "webhook":
+        run_webhook()
+    else:
+        bot.infinity_polling()
\ No newline at end of file
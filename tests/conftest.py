@@ -0,0 +1,8 @@
+import os
+import sys
+
+# Тесты не должны создавать файлы кэшей рядом с репозиторием
+os.environ.setdefault("GEO_CACHE_PATH", "")
+os.environ.setdefault("RESULT_CACHE_PATH", "")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
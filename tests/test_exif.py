@@ -0,0 +1,168 @@
+import io
+import re
+import struct
+from fractions import Fraction
+
+import exifread
+import piexif
+import pytest
+from PIL import Image
+
+import main
+
+SKIPPED_EXIFREAD_TAGS = ('JPEGThumbnail', 'TIFFThumbnail', 'Filename', 'EXIF MakerNote')
+
+
+def make_jpeg(exif_bytes=None):
+    image = Image.new("RGB", (64, 48), (120, 80, 40))
+    out = io.BytesIO()
+    if exif_bytes is None:
+        image.save(out, "JPEG")
+    else:
+        image.save(out, "JPEG", exif=exif_bytes)
+    return out.getvalue()
+
+
+@pytest.fixture
+def photo():
+    exif = {
+        "0th": {
+            piexif.ImageIFD.Make: b"Canon",
+            piexif.ImageIFD.Model: b"EOS 5D",
+            piexif.ImageIFD.Orientation: 1,
+            piexif.ImageIFD.XResolution: (72, 1),
+            piexif.ImageIFD.YResolution: (72, 1),
+        },
+        "Exif": {
+            piexif.ExifIFD.DateTimeOriginal: b"2024:01:01 10:00:00",
+            piexif.ExifIFD.ExposureTime: (1, 125),
+            piexif.ExifIFD.FNumber: (28, 10),
+            piexif.ExifIFD.ExifVersion: b"0230",
+            piexif.ExifIFD.ISOSpeedRatings: 100,
+        },
+        "GPS": {
+            piexif.GPSIFD.GPSLatitudeRef: b"S",
+            piexif.GPSIFD.GPSLatitude: ((44, 1), (57, 1), (1234, 100)),
+            piexif.GPSIFD.GPSLongitudeRef: b"E",
+            piexif.GPSIFD.GPSLongitude: ((34, 1), (6, 1), (3456, 100)),
+        },
+        "1st": {},
+        "thumbnail": None,
+    }
+    return make_jpeg(piexif.dump(exif))
+
+
+def as_numbers(text):
+    """'[44, 57, 617/50]' -> [Fraction, ...]; exifread сокращает дроби, парсер - нет"""
+    parts = text.strip("[]").split(", ")
+    try:
+        return [Fraction(part) for part in parts]
+    except ValueError:
+        return text
+
+
+def test_metadata_matches_exifread(photo):
+    metadata = main.exif_to_metadata(main.parse_exif(photo))
+    tags = exifread.process_file(io.BytesIO(photo), details=False)
+
+    assert tags
+    for name, value in tags.items():
+        if name in SKIPPED_EXIFREAD_TAGS:
+            continue
+        assert f"ExifRead_{name}" in metadata, name
+        assert as_numbers(metadata[f"ExifRead_{name}"]) == as_numbers(str(value)), name
+
+
+def test_raw_values_match_piexif(photo):
+    exif = main.parse_exif(photo)
+    for ifd_name, tags in piexif.load(photo).items():
+        if ifd_name == "thumbnail":
+            continue
+        for tag, value in tags.items():
+            assert exif[ifd_name][tag][1] == value, (ifd_name, tag)
+
+
+def test_gps_coordinates(photo):
+    lat, lon = main.extract_gps(photo)
+    assert lat == pytest.approx(-(44 + 57 / 60 + 12.34 / 3600))
+    assert lon == pytest.approx(34 + 6 / 60 + 34.56 / 3600)
+
+
+def test_no_exif():
+    assert main.parse_exif(make_jpeg()) == {}
+    assert main.extract_gps(make_jpeg()) == (None, None)
+
+
+def test_truncated_exif_does_not_raise(photo):
+    for size in (4, 20, 60, 120, 200):
+        main.parse_exif(photo[:size])
+
+
+def tiff_with_empty_rational():
+    """TIFF (II) с Make и XResolution типа RATIONAL с count = 0"""
+    make = b"Canon\x00"
+    entries = 2
+    data_offset = 8 + 2 + entries * 12 + 4
+    ifd = struct.pack("<H", entries)
+    ifd += struct.pack("<HHLL", 0x010F, 2, len(make), data_offset)
+    ifd += struct.pack("<HHLL", 0x011A, 5, 0, 0)
+    ifd += struct.pack("<L", 0)
+    return b"II*\x00" + struct.pack("<L", 8) + ifd + make
+
+
+def test_empty_rational_keeps_other_metadata():
+    tiff = tiff_with_empty_rational()
+    app1 = b"Exif\x00\x00" + tiff
+    jpeg = make_jpeg()
+    image = jpeg[:2] + b"\xff\xe1" + struct.pack(">H", len(app1) + 2) + app1 + jpeg[2:]
+
+    exif = main.parse_exif(image)
+    assert exif["0th"][0x011A] == (5, ())
+    assert main.format_exif_value(5, ()) == ""
+
+    metadata, _, _, _ = main.extract_metadata_advanced(image)
+    assert metadata["ExifRead_Image Make"] == "Canon"
+    assert metadata["ExifRead_Image XResolution"] == ""
+    assert re.fullmatch(r"\d+", metadata["Image_Width"])
+
+
+@pytest.fixture
+def camera_photo():
+    exif = {
+        "0th": {
+            piexif.ImageIFD.Make: b"Canon",
+            piexif.ImageIFD.XResolution: (72, 1),
+        },
+        "Exif": {
+            piexif.ExifIFD.ExposureBiasValue: (-1, 3),
+            piexif.ExifIFD.UserComment: b"ASCII\x00\x00\x00hello",
+            piexif.ExifIFD.ComponentsConfiguration: b"\x01\x02\x03\x00",
+            piexif.ExifIFD.MakerNote: b"\x00\x01" * 40,
+            piexif.ExifIFD.ExifVersion: b"0230",
+        },
+        "GPS": {
+            piexif.GPSIFD.GPSLatitudeRef: b"N",
+            piexif.GPSIFD.GPSLatitude: ((55, 1), (45, 1), (1234, 100)),
+        },
+        "1st": {},
+        "thumbnail": None,
+    }
+    return make_jpeg(piexif.dump(exif))
+
+
+def test_compat_check_clean_for_camera_photo(camera_photo):
+    exif = main.parse_exif(camera_photo)
+    metadata = main.exif_to_metadata(exif)
+    diff = main.compare_with_legacy_metadata(camera_photo, exif, metadata, *main.extract_gps_from_ifd(exif))
+    assert diff == {'missing_keys': [], 'value_mismatches': [], 'gps_mismatch': None}
+
+
+def test_compat_check_reports_formatted_value_changes(camera_photo):
+    exif = main.parse_exif(camera_photo)
+    metadata = main.exif_to_metadata(exif)
+    metadata["Pillow_XResolution"] = "73"
+    metadata["Pillow_GPSInfo"] = metadata["Pillow_GPSInfo"].replace("1234/100", "1235/100")
+    del metadata["ExifRead_Image Make"]
+    diff = main.compare_with_legacy_metadata(camera_photo, exif, metadata, *main.extract_gps_from_ifd(exif))
+    assert diff['value_mismatches'] == ["Pillow_GPSInfo", "Pillow_XResolution"]
+    assert diff['missing_keys'] == ["ExifRead_Image Make"]
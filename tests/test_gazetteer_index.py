@@ -0,0 +1,54 @@
+import math
+
+import numpy as np
+import pytest
+
+import main
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * main.EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+@pytest.fixture(scope="module")
+def points():
+    rng = np.random.default_rng(42)
+    lats = rng.uniform(-80, 80, 2000)
+    lons = rng.uniform(-180, 180, 2000)
+    names = [f"p{i}" for i in range(len(lats))]
+    return lats, lons, names
+
+
+def test_nearest_matches_brute_force(points):
+    lats, lons, names = points
+    index = main.GazetteerIndex(lats, lons, names, ["RU"] * len(names))
+    rng = np.random.default_rng(7)
+    for lat, lon in zip(rng.uniform(-80, 80, 200), rng.uniform(-180, 180, 200)):
+        i, distance = index.nearest(lat, lon)
+        distances = [haversine_km(lat, lon, a, b) for a, b in zip(lats, lons)]
+        best = int(np.argmin(distances))
+        assert index.names[i] == names[best]
+        assert distance == pytest.approx(distances[best], abs=1e-3)
+
+
+def test_exact_point_has_zero_distance(points):
+    lats, lons, names = points
+    index = main.GazetteerIndex(lats, lons, names, [""] * len(names))
+    i, distance = index.nearest(lats[123], lons[123])
+    assert index.names[i] == "p123"
+    assert distance == pytest.approx(0, abs=1e-6)
+
+
+def test_across_antimeridian():
+    index = main.GazetteerIndex([0.0, 0.0], [179.9, 170.0], ["east", "west"], ["", ""])
+    i, distance = index.nearest(0.0, -179.9)
+    assert index.names[i] == "east"
+    assert distance == pytest.approx(haversine_km(0, -179.9, 0, 179.9), abs=1e-3)
+
+
+def test_empty_index():
+    index = main.GazetteerIndex([], [], [], [])
+    assert len(index) == 0
+    assert index.nearest(10.0, 10.0) == (None, None)
@@ -0,0 +1,30 @@
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize("lat, lon, precision, expected", [
+    (57.64911, 10.40744, 11, "u4pruydqqvj"),
+    (42.6, -5.6, 5, "ezs42"),
+    (-25.382708, -49.265506, 8, "6gkzwgjz"),
+    (0.0, 0.0, 4, "s000"),
+])
+def test_known_values(lat, lon, precision, expected):
+    assert main.geohash_encode(lat, lon, precision) == expected
+
+
+def test_shorter_hash_is_prefix():
+    full = main.geohash_encode(44.952117, 34.102417, 12)
+    for precision in range(1, 12):
+        assert main.geohash_encode(44.952117, 34.102417, precision) == full[:precision]
+
+
+def test_nearby_points_share_cell():
+    # Ячейка 7 символов ~150 м: точки в паре метров друг от друга в одной ячейке
+    assert main.geohash_encode(44.95210, 34.10240, 7) == main.geohash_encode(44.95212, 34.10242, 7)
+    assert main.geohash_encode(44.95210, 34.10240, 7) != main.geohash_encode(44.96210, 34.10240, 7)
+
+
+def test_extreme_coordinates():
+    assert main.geohash_encode(90.0, 180.0, 6) == "zzzzzz"
+    assert main.geohash_encode(-90.0, -180.0, 6) == "000000"
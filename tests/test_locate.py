@@ -0,0 +1,51 @@
+import time
+
+import pytest
+
+import main
+
+LOCAL = {'address': "Москва, RU", 'details': "", 'landmark': None}
+
+
+class FakeLocation:
+    address = "Красная площадь, Москва"
+    raw = {'display_name': "Красная площадь, Москва, Россия", 'address': {}}
+
+
+class FakeGeocoder:
+    def __init__(self):
+        self.calls = 0
+
+    def reverse(self, *args, **kwargs):
+        self.calls += 1
+        return FakeLocation()
+
+
+@pytest.fixture
+def hybrid(monkeypatch):
+    monkeypatch.setattr(main, "GEOCODER_MODE", "hybrid")
+    monkeypatch.setattr(main, "HYBRID_ONLINE_WAIT", 0)
+    monkeypatch.setattr(main, "offline_reverse_geocode", lambda lat, lon: LOCAL)
+    monkeypatch.setattr(main, "geo_cache", {})
+    geocoder = FakeGeocoder()
+    monkeypatch.setattr(main, "geolocator", geocoder)
+    monkeypatch.setattr(main, "backup_geolocator", geocoder)
+    monkeypatch.setattr(main, "geocoder_limiter", main.TokenBucket(rate=0.01, capacity=1))
+    monkeypatch.setattr(main, "photon_limiter", main.TokenBucket(rate=0.01, capacity=1))
+    return geocoder
+
+
+def test_hybrid_refines_when_token_available(hybrid):
+    result = main.locate(55.75, 37.62)
+    assert result['address'] == FakeLocation.address
+    assert hybrid.calls == 1
+
+
+def test_hybrid_returns_offline_without_waiting(hybrid):
+    main.geocoder_limiter.try_acquire()
+    main.photon_limiter.try_acquire()
+
+    started = time.monotonic()
+    assert main.locate(55.75, 37.62) == LOCAL
+    assert time.monotonic() - started < 1
+    assert hybrid.calls == 0
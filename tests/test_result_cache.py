@@ -0,0 +1,56 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import main
+
+
+@pytest.fixture
+def result_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "RESULT_CACHE_PATH", str(tmp_path / "results.sqlite3"))
+    monkeypatch.setattr(main, "result_db_local", main.threading.local())
+    main.result_cache.clear()
+    yield
+    main.result_cache.clear()
+
+
+def make_result():
+    image = Image.new("RGB", (256, 192), (120, 80, 40))
+    image.paste((255, 255, 255), (64, 64, 128, 128))
+    out = io.BytesIO()
+    image.save(out, "JPEG", quality=95)
+    return {
+        'metadata': {'ExifRead_Image Make': 'Canon'},
+        'extracted_count': 1,
+        'lat': 44.95,
+        'lon': 34.1,
+        'address': 'Симферополь',
+        'landmark': None,
+        'geocoding_failed': False,
+        'manipulation_check': main.check_image_manipulation(out.getvalue()),
+        'provenance': None,
+        'report': b'<html></html>',
+    }
+
+
+def test_round_trip_keeps_arrays_and_bytes(result_db):
+    result = make_result()
+    main.result_cache_put("digest", result)
+    main.result_cache.clear()
+
+    cached = main.result_cache_get("digest")
+    check, original = cached['manipulation_check'], result['manipulation_check']
+    for key in ('heatmap', 'tile_max', 'tile_variance'):
+        assert isinstance(check[key], np.ndarray), key
+        assert check[key].dtype == original[key].dtype
+        np.testing.assert_array_equal(check[key], original[key])
+    assert check['ela_image'] == original['ela_image']
+    assert cached['report'] == result['report']
+    assert cached['address'] == 'Симферополь'
+
+
+def test_unknown_types_are_rejected():
+    with pytest.raises(TypeError):
+        main.encode_result({'metadata': {'value': object()}, 'manipulation_check': None})
@@ -0,0 +1,133 @@
+import threading
+import time
+
+import pytest
+
+import main
+
+
+class FakeBot:
+    """Записывает вызовы Bot API; before(method, kwargs) может бросить исключение или подождать"""
+
+    def __init__(self, before=None):
+        self.calls = []
+        self.lock = threading.Lock()
+        self.before = before
+
+    def __getattr__(self, method):
+        def call(*args, **kwargs):
+            if self.before:
+                self.before(method, args, kwargs)
+            with self.lock:
+                self.calls.append((method, args, kwargs))
+            return method
+        return call
+
+
+class TooManyRequests(Exception):
+    error_code = 429
+
+    def __init__(self, retry_after):
+        super().__init__("Too Many Requests")
+        self.result_json = {'parameters': {'retry_after': retry_after}}
+
+
+def make_gateway(senders=1):
+    return main.TelegramGateway(senders, global_rate=100, chat_rate=100, chat_burst=100, max_retries=3)
+
+
+def test_unknown_method_is_attribute_error(monkeypatch):
+    monkeypatch.setattr(main, "bot", FakeBot())
+    gateway = make_gateway()
+    with pytest.raises(AttributeError):
+        gateway.send_mesage(1, "typo")
+    with pytest.raises(AttributeError):
+        gateway.submit("get_me")
+    assert gateway.send_message(1, "hi") == "send_message"
+
+
+def test_retry_after_429(monkeypatch):
+    failures = []
+
+    def before(method, args, kwargs):
+        if not failures:
+            failures.append(method)
+            raise TooManyRequests(0.2)
+
+    fake = FakeBot(before)
+    monkeypatch.setattr(main, "bot", fake)
+    gateway = make_gateway()
+    started = time.monotonic()
+    assert gateway.send_message(7, "hi") == "send_message"
+    assert time.monotonic() - started >= 0.2
+    assert len(fake.calls) == 1
+
+
+def test_429_without_chat_pauses_global_bucket(monkeypatch):
+    failures = []
+
+    def before(method, args, kwargs):
+        if not failures:
+            failures.append(method)
+            raise TooManyRequests(0.3)
+
+    monkeypatch.setattr(main, "bot", FakeBot(before))
+    gateway = make_gateway()
+    gateway.submit("send_message", text="no chat").result()
+    assert gateway.global_bucket.paused_until > 0
+    assert not gateway.chat_buckets
+
+
+def test_error_after_retries(monkeypatch):
+    def before(method, args, kwargs):
+        raise TooManyRequests(0.01)
+
+    monkeypatch.setattr(main, "bot", FakeBot(before))
+    gateway = make_gateway()
+    with pytest.raises(TooManyRequests):
+        gateway.send_message(1, "hi")
+
+
+def test_queued_edits_merge_and_results_go_first(monkeypatch):
+    fake = FakeBot()
+    monkeypatch.setattr(main, "bot", fake)
+    gateway = make_gateway()
+    gateway._chat_bucket(8).pause(0.2)  # Запросы копятся в очереди
+    edits = [gateway.submit("edit_message_text", chat_id=8, message_id=1, text=f"v{i}") for i in range(5)]
+    document = gateway.submit("send_document", 8, b"report")
+    for future in edits + [document]:
+        future.result(timeout=5)
+    assert [(method, kwargs.get("text")) for method, _, kwargs in fake.calls] == [
+        ("send_document", None), ("edit_message_text", "v4")
+    ]
+
+
+def test_delete_cancels_pending_edit(monkeypatch):
+    fake = FakeBot()
+    monkeypatch.setattr(main, "bot", fake)
+    gateway = make_gateway()
+    gateway._chat_bucket(9).pause(0.2)
+    edit = gateway.submit("edit_message_text", chat_id=9, message_id=2, text="x")
+    delete = gateway.submit("delete_message", 9, 2)
+    assert edit.result(timeout=5) is None
+    delete.result(timeout=5)
+    assert [method for method, _, _ in fake.calls] == ["delete_message"]
+
+
+def test_edits_of_one_message_are_sent_in_order(monkeypatch):
+    first_sent = threading.Event()
+
+    def before(method, args, kwargs):
+        if kwargs.get("text") == "old":
+            first_sent.set()
+            time.sleep(0.3)  # Медленная доставка старой правки
+
+    fake = FakeBot(before)
+    monkeypatch.setattr(main, "bot", fake)
+    gateway = make_gateway(senders=4)
+    old = gateway.submit("edit_message_text", chat_id=1, message_id=5, text="old")
+    first_sent.wait(5)
+    new = gateway.submit("edit_message_text", chat_id=1, message_id=5, text="new")
+    old.result(timeout=5)
+    new.result(timeout=5)
+    assert [kwargs["text"] for _, _, kwargs in fake.calls] == ["old", "new"]
@@ -0,0 +1,53 @@
+import time
+
+import pytest
+
+import main
+
+
+def test_burst_then_wait():
+    bucket = main.TokenBucket(rate=10, capacity=3)
+    assert [bucket.try_acquire() for _ in range(3)] == [0.0, 0.0, 0.0]
+    wait = bucket.try_acquire()
+    assert 0 < wait <= 0.1 + 1e-6
+
+
+def test_refill_over_time():
+    bucket = main.TokenBucket(rate=20, capacity=1)
+    assert bucket.try_acquire() == 0.0
+    assert bucket.try_acquire() > 0
+    time.sleep(0.06)
+    assert bucket.try_acquire() == 0.0
+
+
+def test_acquire_blocks_until_token():
+    bucket = main.TokenBucket(rate=20, capacity=1)
+    bucket.acquire()
+    started = time.monotonic()
+    assert bucket.acquire(timeout=1)
+    assert time.monotonic() - started == pytest.approx(0.05, abs=0.04)
+
+
+def test_acquire_timeout():
+    bucket = main.TokenBucket(rate=1, capacity=1)
+    bucket.acquire()
+    started = time.monotonic()
+    assert bucket.acquire(timeout=0.1) is False
+    assert time.monotonic() - started < 0.1
+
+
+def test_refund_returns_token():
+    bucket = main.TokenBucket(rate=0.1, capacity=1)
+    assert bucket.try_acquire() == 0.0
+    bucket.refund()
+    assert bucket.try_acquire() == 0.0
+
+
+def test_pause_blocks_tokens():
+    bucket = main.TokenBucket(rate=100, capacity=5)
+    bucket.pause(0.2)
+    wait = bucket.try_acquire()
+    assert 0.15 < wait <= 0.2
+    assert bucket.acquire(timeout=0.05) is False
+    time.sleep(0.2)
+    assert bucket.try_acquire() == 0.0
@@ -0,0 +1,61 @@
+import http.client
+import json
+import queue
+
+import pytest
+
+import main
+
+SECRET = "s3cret"
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(main, "WEBHOOK_LISTEN", "127.0.0.1")
+    monkeypatch.setattr(main, "WEBHOOK_PORT", 0)
+    monkeypatch.setattr(main, "WEBHOOK_SECRET", SECRET)
+    monkeypatch.setattr(main, "update_queue", queue.Queue(maxsize=1))
+    server = main.start_webhook_server()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def post(server, body=b"", secret=SECRET, path=main.WEBHOOK_PATH, headers=None):
+    connection = http.client.HTTPConnection(*server.server_address[:2], timeout=5)
+    request_headers = {"X-Telegram-Bot-Api-Secret-Token": secret}
+    request_headers.update(headers or {})
+    connection.request("POST", path, body=body, headers=request_headers)
+    status = connection.getresponse().status
+    connection.close()
+    return status
+
+
+UPDATE = json.dumps({"update_id": 1}).encode()
+
+
+def test_wrong_secret_rejected(server):
+    assert post(server, UPDATE, secret="wrong") == 403
+    assert main.update_queue.empty()
+
+
+def test_wrong_path(server):
+    assert post(server, UPDATE, path="/other") == 404
+
+
+def test_valid_update_queued(server):
+    assert post(server, UPDATE) == 200
+    assert main.update_queue.get_nowait() == UPDATE
+
+
+def test_full_queue_returns_503(server):
+    assert post(server, UPDATE) == 200
+    assert post(server, UPDATE) == 503
+    assert main.update_queue.qsize() == 1
+
+
+def test_bad_content_length(server):
+    assert post(server, headers={"Content-Length": "abc"}) == 400
+    assert post(server, headers={"Content-Length": "0"}) == 400
+    assert post(server, headers={"Content-Length": str(main.WEBHOOK_MAX_BODY + 1)}) == 413
+    assert main.update_queue.empty()